@@ -2,10 +2,10 @@ call activate "Extreme Events Tool"
 pyinstaller main.py --name ExtremeEvents --onefile -y -w ^
 --add-data "C:\ProgramData\Anaconda3\envs\Extreme Events Tool\Lib\site-packages\dask\dask.yaml;./dask" ^
 --add-data "C:\ProgramData\Anaconda3\envs\Extreme Events Tool\Lib\site-packages\distributed\distributed.yaml;./distributed" ^
---add-data "D:\Documents\My_Actual_Files\USQ_Work\FWFA\HEEAT\venv\Lib\site-packages\xarray-999-py3.8.egg\xarray\static;./xarray/static" ^
---add-data "data/locations.txt;./data" ^
---add-data "data/windspeed.nc;./data" ^
---add-data "data/precipitation.nc;./data" ^
---add-data "data/minimum_temperature.nc;./data" ^
---add-data "data/maximum_temperature.nc;./data"
+--add-data "D:\Documents\My_Actual_Files\USQ_Work\FWFA\HEEAT\venv\Lib\site-packages\xarray-999-py3.8.egg\xarray\static;./xarray/static"
+rem The data is not bundled into the executable, which would unpack it on every start. It is read in place from the
+rem data directory next to ExtremeEvents.exe.
+if not exist dist\data mkdir dist\data
+copy /Y data\locations.txt dist\data
+copy /Y data\*.nc dist\data
 conda deactivate
\ No newline at end of file
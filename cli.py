@@ -0,0 +1,5 @@
+from source import cli
+
+# Runs queries from the command line, without starting the GUI
+if __name__ == '__main__':
+    cli.main()
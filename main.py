@@ -1,5 +1,15 @@
+import time
+# Taken before anything else is imported, so the startup time reported by the GUI covers the whole startup
+start_time = time.perf_counter()
+
 from source import gui
+import logging
+import multiprocessing
 
 # Starts the application
 if __name__ == '__main__':
-    gui.MainApplication()
+    # Allows worker processes used for parallel queries to start when packaged by PyInstaller
+    multiprocessing.freeze_support()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s",
+                        datefmt="%Y-%m-%d  %H:%M:%S")
+    gui.MainApplication(start_time)
@@ -0,0 +1,292 @@
+import argparse
+import concurrent.futures
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import sys
+import time
+import dask.array
+import numpy
+import pandas
+import xarray
+from source import data, query, repack, resources, result_cache, station_store, sweep
+from utils import save_to_netcdf
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where peak memory is not reported
+    resource = None
+
+"""
+Measures how quickly the query engine answers single-station queries, on synthetic data with the same layout as the
+real netCDF files: one file per variable, each on a (region, time) grid with a daily time axis starting in 1889.
+
+The synthetic data has a seasonal cycle and random day-to-day variation, so the benchmark queries find a realistic
+number of events. Like the real data, values are stored as float32 to one decimal place. Any number of stations and years can be generated, and the files are written a chunk of stations at
+a time, so large datasets can be generated with little memory.
+
+Each query is run in a fresh process. The first run is cold: the data files have not been opened, and nothing is cached.
+Later runs are warm: the station is already in memory, but the result cache is cleared so the search itself is timed.
+Results are written as JSON, so they can be compared between versions to catch regressions.
+"""
+
+# First year of the synthetic data, the same as the real data
+FIRST_YEAR = 1889
+
+# Default size of the synthetic data, the same as the real data
+DEFAULT_STATIONS = 100
+DEFAULT_YEARS = 127
+
+# Number of stations generated at a time
+GENERATE_CHUNK_SIZE = 16
+
+# Number of warm runs of each query. The fastest is reported.
+DEFAULT_REPEATS = 5
+
+# The queries that are timed, one for each way the engine searches: days meeting temperature and wind conditions only,
+# accumulated precipitation only, and both combined. Each is also run with the months filtered.
+BENCHMARK_QUERIES = {
+    'temperature_wind': {
+        'temperature': {'condition': 'Higher Than', 'value': 30.0},
+        'precipitation': {'condition': 'Any', 'value': None},
+        'wind': {'condition': 'Higher Than', 'value': 3.0},
+        'consecutive_days': 2
+    },
+    'precipitation': {
+        'temperature': {'condition': 'Any', 'value': None},
+        'precipitation': {'condition': 'Higher Than', 'value': 50.0},
+        'wind': {'condition': 'Any', 'value': None},
+        'consecutive_days': 5
+    },
+    'combined': {
+        'temperature': {'condition': 'Higher Than', 'value': 28.0},
+        'precipitation': {'condition': 'Lower Than', 'value': 1.0},
+        'wind': {'condition': 'Any', 'value': None},
+        'consecutive_days': 3
+    }
+}
+
+# Months selected in the month-filtered queries (December to February)
+FILTERED_MONTHS = [True, True] + [False] * 9 + [True]
+
+# Sweeps checked against single queries by check_sweeps: (parameters, thresholds, consecutive_days). Thresholds step by
+# the data's precision, so many days are exactly equal to a threshold.
+CHECK_SWEEPS = {
+    'temperature': ({
+        'temperature': {'condition': 'Higher Than', 'value': None},
+        'precipitation': {'condition': 'Any', 'value': None},
+        'wind': {'condition': 'Higher Than', 'value': 4.0}
+    }, {'temperature': numpy.arange(300, 330) / 10}, [1, 2, 3]),
+    'temperature_wind': ({
+        'temperature': {'condition': 'Lower Than', 'value': None},
+        'precipitation': {'condition': 'Any', 'value': None},
+        'wind': {'condition': 'Lower Than', 'value': None}
+    }, {'temperature': numpy.arange(100, 120, 2) / 10, 'wind': numpy.arange(40, 60) / 10}, [1, 2]),
+    'wind_percentile': ({
+        'temperature': {'condition': 'Any', 'value': None},
+        'precipitation': {'condition': 'Any', 'value': None},
+        'wind': {'condition': 'Higher Than', 'as_percentile': True, 'value': None}
+    }, {'wind': numpy.arange(80, 100, 2.5)}, [1, 2]),
+    'precipitation': ({
+        'temperature': {'condition': 'Higher Than', 'value': 25.0},
+        'precipitation': {'condition': 'Higher Than', 'value': None},
+        'wind': {'condition': 'Any', 'value': None}
+    }, {'precipitation': numpy.arange(0, 50) / 10}, [1, 3])
+}
+
+logger = logging.getLogger(__name__)
+
+
+# Writes synthetic netCDF files for every variable to directory, with the names the program expects, along with a
+# locations.txt naming each station. The region coordinate is the station index, as in the real data.
+def generate_dataset(directory, stations=DEFAULT_STATIONS, years=DEFAULT_YEARS, seed=0):
+    os.makedirs(directory, exist_ok=True)
+    time_axis = pandas.date_range('{}-01-01'.format(FIRST_YEAR), '{}-12-31'.format(FIRST_YEAR + years - 1), freq='D')
+    shape = (stations, time_axis.size)
+    chunks = (GENERATE_CHUNK_SIZE, time_axis.size)
+    random = dask.array.random.RandomState(seed)
+    season = numpy.cos(2 * numpy.pi * (time_axis.dayofyear.values - 15) / 365.25)[numpy.newaxis, :]
+
+    minimum_temperature = 15 + 7 * season + 4 * random.standard_normal(shape, chunks=chunks)
+    maximum_temperature = minimum_temperature + 10 + 3 * random.random_sample(shape, chunks=chunks)
+    wet = random.random_sample(shape, chunks=chunks) < 0.25
+    precipitation = dask.array.where(wet, random.gamma(0.8, 8, shape, chunks=chunks), 0)
+    windspeed = abs(5 + season + 3 * random.standard_normal(shape, chunks=chunks))
+    values = {
+        'minimum_temperature': minimum_temperature,
+        'maximum_temperature': maximum_temperature,
+        'precipitation': precipitation,
+        'windspeed': windspeed
+    }
+    for variable in data.VARIABLES:
+        # Values are stored to 0.1 as float32, like the real data, so many days equal a round threshold exactly
+        dataset = xarray.Dataset({variable: (('region', 'time'), values[variable].round(1).astype(numpy.float32))},
+                                 coords={'region': numpy.arange(stations), 'time': time_axis})
+        path = os.path.join(directory, variable + '.nc')
+        if os.path.exists(path):
+            os.remove(path)
+        save_to_netcdf(dataset, path, repack.build_encoding(dataset, repack.DEFAULT_CHUNKS, repack.DEFAULT_COMPLEVEL,
+                                                            True), logging.INFO, unlimited_dims=None,
+                       raise_errors=True)
+    with open(os.path.join(directory, 'locations.txt'), 'w') as file:
+        file.write('\n'.join('Station {}'.format(station) for station in range(stations)))
+
+
+# Returns the queries to time, as {} of name to parameters in the structure described in query.ThreadedQuery.run
+def benchmark_queries(station):
+    queries = {}
+    for name, settings in BENCHMARK_QUERIES.items():
+        for suffix, months in [('', [True] * 12), ('_months', FILTERED_MONTHS)]:
+            parameters = {variable: dict(value) if isinstance(value, dict) else value
+                          for variable, value in settings.items()}
+            parameters['station'] = station
+            parameters['months'] = months
+            queries[name + suffix] = parameters
+    return queries
+
+
+# Returns the most memory this process has used so far, in megabytes, or None where this cannot be measured
+def peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS, and in kilobytes elsewhere
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+# Times one query in this process: a cold run, then warm runs. Runs in a fresh process, started by run_benchmark.
+# Returns {} of measurements
+def _time_query(parameters, repeats):
+    start = time.perf_counter()
+    results = query.run_query(parameters)
+    cold_time = time.perf_counter() - start
+
+    warm_times = []
+    for _ in range(repeats):
+        result_cache.cache.clear()
+        start = time.perf_counter()
+        query.run_query(parameters)
+        warm_times.append(time.perf_counter() - start)
+    warm_time = min(warm_times)
+    return {
+        'events': len(results),
+        'cold_seconds': cold_time,
+        'warm_seconds': warm_time,
+        'warm_seconds_median': float(numpy.median(warm_times)),
+        'events_per_second': len(results) / warm_time if warm_time > 0 else None,
+        'peak_rss_mb': peak_rss()
+    }
+
+
+# Checks that threshold sweeps count the same events as single queries with each of the same thresholds and durations,
+# on the data in directory.
+# Returns a list of {} describing each count that differs, empty if every count agrees
+def check_sweeps(directory, station=0):
+    os.environ[resources.DATA_DIRECTORY_VARIABLE] = os.path.abspath(directory)
+    mismatches = []
+    for name, (settings, thresholds, consecutive_days) in CHECK_SWEEPS.items():
+        logger.info('Checking sweep ' + name)
+        parameters = {variable: dict(value) for variable, value in settings.items()}
+        parameters['station'] = station
+        parameters['months'] = [True] * 12
+        parameters['consecutive_days'] = 1
+        counts = sweep.threshold_sweep(parameters, thresholds, consecutive_days)['counts']
+        variables = list(thresholds)
+        for cell in numpy.ndindex(counts.shape):
+            cell_parameters = {key: dict(value) if isinstance(value, dict) else value
+                               for key, value in parameters.items()}
+            for variable, i in zip(variables, cell[:-1]):
+                cell_parameters[variable]['value'] = float(thresholds[variable][i])
+            cell_parameters['consecutive_days'] = int(consecutive_days[cell[-1]])
+            found = len(query.find_query_events(cell_parameters))
+            if found != counts[cell]:
+                mismatches.append({
+                    'sweep': name,
+                    'thresholds': {variable: cell_parameters[variable]['value'] for variable in variables},
+                    'consecutive_days': cell_parameters['consecutive_days'],
+                    'sweep_count': int(counts[cell]),
+                    'query_count': found
+                })
+    return mismatches
+
+
+# Times every benchmark query against the data in directory, each in a fresh process so that cold runs and peak memory
+# are measured separately for each query. If use_store is True, the station store is built first and queries read from
+# it; otherwise they read the netCDF files.
+# Returns {} describing the machine, the data and the measurements for each query
+def run_benchmark(directory, station=0, repeats=DEFAULT_REPEATS, use_store=False, names=None):
+    # Worker processes find the data through the environment they inherit
+    os.environ[resources.DATA_DIRECTORY_VARIABLE] = os.path.abspath(directory)
+    if use_store:
+        if not station_store.store_is_current():
+            station_store.build_store()
+    elif station_store.store_exists():
+        raise ValueError('Remove the station store from {} to benchmark reading the netCDF files'.format(directory))
+    with data.open_dataset() as dataset:
+        stations = dataset.region.size
+        times = dataset.time.size
+    queries = benchmark_queries(station)
+    if names is not None:
+        queries = {name: queries[name] for name in names}
+    measurements = {}
+    for name, parameters in queries.items():
+        logger.info('Timing ' + name)
+        # Workers are always spawned rather than forked, so that nothing is inherited already loaded
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1,
+                                                    mp_context=multiprocessing.get_context('spawn')) as executor:
+            measurements[name] = executor.submit(_time_query, parameters, repeats).result()
+    return {
+        'machine': {
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'python': platform.python_version(),
+            'cpus': os.cpu_count()
+        },
+        'data': {'stations': int(stations), 'days': int(times), 'station_store': use_store},
+        'repeats': repeats,
+        'queries': measurements
+    }
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s",
+                        datefmt="%Y-%m-%d  %H:%M:%S")
+    parser = argparse.ArgumentParser(description='Benchmark single-station queries on synthetic data.')
+    parser.add_argument('--data', required=True, help='directory holding the synthetic data, generated if empty')
+    parser.add_argument('--generate', action='store_true', help='(re)generate the synthetic data before timing')
+    parser.add_argument('--stations', type=int, default=DEFAULT_STATIONS,
+                        help='number of stations to generate (default: {})'.format(DEFAULT_STATIONS))
+    parser.add_argument('--years', type=int, default=DEFAULT_YEARS,
+                        help='number of years to generate, from {} (default: {})'.format(FIRST_YEAR, DEFAULT_YEARS))
+    parser.add_argument('--seed', type=int, default=0, help='seed for the synthetic data (default: 0)')
+    parser.add_argument('--station', type=int, default=0, help='station to query (default: 0)')
+    parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS,
+                        help='number of warm runs of each query (default: {})'.format(DEFAULT_REPEATS))
+    parser.add_argument('--store', action='store_true', help='build and read from the station store')
+    parser.add_argument('--query', nargs='+', choices=list(benchmark_queries(0)), help='only time these queries')
+    parser.add_argument('--output', help='file to write the results to as JSON (default: stdout)')
+    parser.add_argument('--check-sweeps', action='store_true',
+                        help='check that threshold sweeps count the same events as queries, instead of timing')
+    args = parser.parse_args()
+    if args.stations < 1 or args.years < 1 or args.repeats < 1:
+        parser.error('--stations, --years and --repeats must be at least 1')
+    if args.generate or not os.path.exists(os.path.join(args.data, data.VARIABLES[0] + '.nc')):
+        generate_dataset(args.data, args.stations, args.years, args.seed)
+    if args.check_sweeps:
+        differences = check_sweeps(args.data, args.station)
+        for difference in differences:
+            logger.error('Sweep and query counts differ: {}'.format(difference))
+        if differences:
+            sys.exit(1)
+        logger.info('Sweep counts match queries')
+        sys.exit(0)
+    report = run_benchmark(args.data, args.station, args.repeats, args.store, args.query)
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
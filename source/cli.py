@@ -0,0 +1,379 @@
+import argparse
+import csv
+import itertools
+import json
+import logging
+import numpy
+import sys
+from source import export, query, parallel, profiling, server, sweep, result_cache, resources
+
+"""
+Command line interface for running queries without the GUI. Does not import tkinter, so it can be used on servers
+without a display and scripted for large numbers of runs.
+
+Example, days over 35 °C for at least 3 days in summer at the first station:
+
+    python cli.py query --station 0 --temperature higher 35 --days 3 --months 12 1 2
+
+Example, counts of hot spells for every threshold from 30 °C to 45 °C and durations of 1 to 5 days:
+
+    python cli.py sweep --station 0 --temperature higher 30:45:0.5 --days 1 2 3 4 5
+
+Example, answer queries over HTTP from a long-running process (see source/server.py):
+
+    python cli.py serve --port 8765 --workers 4
+"""
+
+CONDITIONS = {'higher': 'Higher Than', 'lower': 'Lower Than'}
+
+MONTH_NAMES = ['january', 'february', 'march', 'april', 'may', 'june', 'july', 'august', 'september', 'october',
+               'november', 'december']
+
+# Valid ranges for each threshold, the same as those enforced by the GUI
+LIMITS = {
+    'temperature': (-273, 100),
+    'precipitation': (0, 5000),
+    'wind': (0, 600)
+}
+
+# Valid range for thresholds given as percentiles
+PERCENTILE_LIMITS = (0, 100)
+
+
+# Finds a station by its index or its name in data/locations.txt. Names are matched ignoring case.
+# Returns the station's index
+def resolve_station(station, stations):
+    try:
+        index = int(station)
+    except ValueError:
+        names = [name.strip().lower() for name in stations]
+        if station.strip().lower() not in names:
+            raise ValueError('Unknown station: ' + station)
+        return names.index(station.strip().lower())
+    if not 0 <= index < len(stations):
+        raise ValueError('Station index must be between 0 and {}'.format(len(stations) - 1))
+    return index
+
+
+# Turns a month given as a number (1-12) or a name, or the start of a name, into an index (0-11)
+def resolve_month(month):
+    try:
+        number = int(month)
+    except ValueError:
+        matches = [i for i, name in enumerate(MONTH_NAMES) if name.startswith(month.lower())]
+        if len(matches) != 1:
+            raise ValueError('Unknown month: ' + month)
+        return matches[0]
+    if not 1 <= number <= 12:
+        raise ValueError('Months must be between 1 and 12')
+    return number - 1
+
+
+# Assembles query parameters in the structure expected by query.ThreadedQuery from command line style arguments.
+#   temperature, precipitation, wind: (condition, value) where condition is 'higher' or 'lower', or None for 'Any'
+#   months: list of months as numbers or names, or None for all months
+#   percentiles: variables whose values are percentiles (0-100) of the station's own record rather than measurements
+#   by_month: if True, percentiles are of each calendar month separately
+def build_parameters(station, temperature=None, precipitation=None, wind=None, consecutive_days=1, months=None,
+                     percentiles=(), by_month=False):
+    parameters = {
+        'station': station,
+        'consecutive_days': consecutive_days,
+        'months': [True] * 12
+    }
+    for variable, threshold in [('temperature', temperature), ('precipitation', precipitation), ('wind', wind)]:
+        if threshold is None:
+            parameters[variable] = {'condition': 'Any', 'as_percentile': False, 'value': None}
+            continue
+        condition, value = threshold
+        if condition.lower() not in CONDITIONS:
+            raise ValueError('Condition for {} must be one of: {}'.format(variable, ', '.join(CONDITIONS)))
+        value = float(value)
+        as_percentile = variable in percentiles
+        minimum, maximum = PERCENTILE_LIMITS if as_percentile else LIMITS[variable]
+        if not minimum <= value <= maximum:
+            raise ValueError('Value for {} must be between {} and {}'.format(variable, minimum, maximum))
+        parameters[variable] = {'condition': CONDITIONS[condition.lower()], 'as_percentile': as_percentile,
+                                'percentile_by_month': by_month, 'value': value}
+    if all(parameters[variable]['condition'] == 'Any' for variable in LIMITS):
+        raise ValueError('No conditions have been selected. Set at least one of temperature, precipitation or wind.')
+    if not 1 <= consecutive_days <= 365:
+        raise ValueError('Duration must be between 1 and 365 days')
+    if months is not None:
+        parameters['months'] = [False] * 12
+        for month in months:
+            parameters['months'][resolve_month(month)] = True
+    return parameters
+
+
+# Writes results for one or more stations. results is a dict of station index to an events.EventList. Each station's
+# dates are formatted all at once.
+def write_results(results, stations, output_format, file):
+    if output_format == 'json':
+        json.dump([{
+            'station': station,
+            'name': stations[station] if station < len(stations) else None,
+            'count': len(events),
+            'events': [{'start_date': start, 'end_date': end} for start, end in zip(*_iso_dates(events))]
+        } for station, events in results.items()], file, indent=2)
+        file.write('\n')
+    else:
+        writer = csv.writer(file, lineterminator='\n')
+        writer.writerow(['station', 'name', 'start_date', 'end_date'])
+        for station, events in results.items():
+            name = stations[station] if station < len(stations) else ''
+            writer.writerows([station, name, start, end] for start, end in zip(*_iso_dates(events)))
+
+
+# Writes statistics for the events at one or more stations, as calculated by events.event_statistics, instead of the
+# events themselves. results is a dict of station index to an events.EventList. CSV output has one row for each
+# statistic, with the year, decade or month it applies to as the period.
+def write_statistics(results, stations, output_format, file):
+    if output_format == 'json':
+        json.dump([dict({
+            'station': station,
+            'name': stations[station] if station < len(stations) else None
+        }, **events.statistics()) for station, events in results.items()], file, indent=2)
+        file.write('\n')
+        return
+    writer = csv.writer(file, lineterminator='\n')
+    writer.writerow(['station', 'name', 'statistic', 'period', 'value'])
+    for station, events in results.items():
+        name = stations[station] if station < len(stations) else ''
+        statistics = events.statistics()
+        for key in ['events', 'years', 'events_per_year', 'mean_duration', 'max_duration', 'return_period',
+                    'years_with_events', 'annual_return_period']:
+            writer.writerow([station, name, key, '', '' if statistics[key] is None else statistics[key]])
+        years = range(statistics['first_year'], statistics['last_year'] + 1)
+        periods = [('events_in_year', years, statistics['per_year']),
+                   ('events_in_decade', statistics['decades'], statistics['per_decade']),
+                   ('events_in_month', range(1, 13), statistics['per_month'])]
+        for key, labels, counts in periods:
+            writer.writerows([station, name, key, label, count] for label, count in zip(labels, counts))
+
+
+# Returns the start and end dates of an events.EventList as lists of YYYY-MM-DD strings
+def _iso_dates(events):
+    start_dates, end_dates = events.iso_dates()
+    return start_dates.tolist(), end_dates.tolist()
+
+
+# Expands threshold values given on the command line. Each value is either a number, or a range written as
+# start:stop:step, which includes stop if it falls on a step.
+def parse_threshold_values(values):
+    expanded = []
+    for value in values:
+        if ':' in value:
+            start, stop, step = [float(part) for part in value.split(':')]
+            if step <= 0:
+                raise ValueError('Step must be positive: ' + value)
+            expanded.extend(numpy.arange(start, stop + step / 2, step).round(10).tolist())
+        else:
+            expanded.append(float(value))
+    return expanded
+
+
+# Writes the counts from a threshold sweep, with one row for each combination of thresholds and duration
+def write_sweep(results, output_format, file):
+    variables = list(results['thresholds'])
+    rows = []
+    for index in itertools.product(*[range(size) for size in results['counts'].shape]):
+        row = {variable: float(results['thresholds'][variable][i]) for variable, i in zip(variables, index)}
+        row['consecutive_days'] = int(results['consecutive_days'][index[-1]])
+        row['count'] = int(results['counts'][index])
+        rows.append(row)
+    if output_format == 'json':
+        json.dump(rows, file, indent=2)
+        file.write('\n')
+    else:
+        writer = csv.DictWriter(file, fieldnames=variables + ['consecutive_days', 'count'], lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def _add_query_arguments(parser):
+    parser.add_argument('--temperature', nargs=2, metavar=('CONDITION', 'VALUE'),
+                        help='higher or lower, and a temperature in °C')
+    parser.add_argument('--precipitation', nargs=2, metavar=('CONDITION', 'VALUE'),
+                        help='higher or lower, and precipitation in mm accumulated over the duration')
+    parser.add_argument('--wind', nargs=2, metavar=('CONDITION', 'VALUE'), help='higher or lower, and a windspeed')
+    parser.add_argument('--days', type=int, default=1, help='minimum number of consecutive days (default: 1)')
+    parser.add_argument('--months', nargs='+', metavar='MONTH',
+                        help='months to include, as numbers or names (default: all months)')
+    _add_percentile_arguments(parser)
+
+
+def _add_percentile_arguments(parser):
+    parser.add_argument('--percentile', nargs='+', choices=list(LIMITS), default=[], metavar='VARIABLE',
+                        help='treat the values for these variables as percentiles (0-100) of the station\'s record')
+    parser.add_argument('--by-month', action='store_true',
+                        help='calculate percentiles for each calendar month separately')
+
+
+def _create_parser():
+    parser = argparse.ArgumentParser(description='Search historical records for extreme events without the GUI.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    query_parser = subparsers.add_parser('query', help='search for events at one station, or every station')
+    station_group = query_parser.add_mutually_exclusive_group(required=True)
+    station_group.add_argument('--station', help='station name from data/locations.txt, or its index')
+    station_group.add_argument('--all-stations', action='store_true', help='search every station')
+    _add_query_arguments(query_parser)
+    query_parser.add_argument('--format', choices=['csv', 'json'], default='csv', help='output format (default: csv)')
+    query_parser.add_argument('--statistics', action='store_true',
+                              help='write the number of events in each year, decade and month, their durations and '
+                                   'return periods, instead of the events')
+    query_parser.add_argument('--output', help='file to write results to (default: stdout)')
+    query_parser.add_argument('--export', metavar='FILE',
+                              help='write the events to FILE as they are found, as CSV (.csv), Parquet (.parquet, '
+                                   'needs pyarrow) or netCDF (.nc), instead of using --format and --output')
+    query_parser.add_argument('--workers', type=int, default=1,
+                              help='worker processes to use with --all-stations (default: 1)')
+    query_parser.add_argument('--result-cache', metavar='FILE',
+                              help='SQLite file to keep results in, so repeated queries return immediately')
+    query_parser.add_argument('--timings', action='store_true',
+                              help='log the time and memory taken by each stage of the query to stderr')
+    query_parser.add_argument('--profile', metavar='FILE', help='profile the query, and write the statistics to FILE')
+
+    sweep_parser = subparsers.add_parser('sweep', help='count events at one station for a grid of thresholds')
+    sweep_parser.add_argument('--station', required=True, help='station name from data/locations.txt, or its index')
+    for variable, unit in [('temperature', '°C'), ('precipitation', 'mm'), ('wind', 'windspeed')]:
+        sweep_parser.add_argument('--' + variable, nargs='+', metavar=('CONDITION', 'VALUE'),
+                                  help='higher or lower, and one or more values ({}) or start:stop:step ranges. '
+                                       'Give one value to hold it fixed.'.format(unit))
+    sweep_parser.add_argument('--days', type=int, nargs='+', default=[1],
+                              help='one or more minimum numbers of consecutive days (default: 1)')
+    sweep_parser.add_argument('--months', nargs='+', metavar='MONTH',
+                              help='months to include, as numbers or names (default: all months)')
+    _add_percentile_arguments(sweep_parser)
+    sweep_parser.add_argument('--format', choices=['csv', 'json'], default='csv', help='output format (default: csv)')
+    sweep_parser.add_argument('--output', help='file to write results to (default: stdout)')
+
+    serve_parser = subparsers.add_parser('serve', help='answer queries over a local HTTP/JSON API')
+    serve_parser.add_argument('--host', default=server.DEFAULT_HOST,
+                              help='address to listen on (default: {}, this machine only)'.format(server.DEFAULT_HOST))
+    serve_parser.add_argument('--port', type=int, default=server.DEFAULT_PORT,
+                              help='port to listen on (default: {})'.format(server.DEFAULT_PORT))
+    serve_parser.add_argument('--workers', type=int, default=server.DEFAULT_WORKERS,
+                              help='requests answered at once (default: {})'.format(server.DEFAULT_WORKERS))
+    serve_parser.add_argument('--warm', nargs='+', default=[], metavar='STATION',
+                              help='stations to load into memory before the first request, by name or index')
+    serve_parser.add_argument('--percentiles', action='store_true',
+                              help='load the climatology table before the first request')
+    serve_parser.add_argument('--result-cache', metavar='FILE',
+                              help='SQLite file to keep results in, shared with other runs')
+    return parser
+
+
+def _run_sweep(args, parser):
+    stations = resources.get_all_stations()
+    thresholds = {}
+    fixed = {}
+    try:
+        station = resolve_station(args.station, stations)
+        for variable in LIMITS:
+            arguments = getattr(args, variable)
+            if arguments is None:
+                fixed[variable] = None
+                continue
+            if len(arguments) < 2:
+                raise ValueError('Give a condition and at least one value for ' + variable)
+            values = parse_threshold_values(arguments[1:])
+            fixed[variable] = (arguments[0], values[0])
+            if len(values) > 1:
+                thresholds[variable] = values
+        parameters = build_parameters(station, fixed['temperature'], fixed['precipitation'], fixed['wind'], 1,
+                                      args.months, args.percentile, args.by_month)
+        for variable, values in thresholds.items():
+            minimum, maximum = PERCENTILE_LIMITS if variable in args.percentile else LIMITS[variable]
+            if not minimum <= min(values) <= max(values) <= maximum:
+                raise ValueError('Values for {} must be between {} and {}'.format(variable, minimum, maximum))
+        if not 1 <= min(args.days) <= max(args.days) <= 365:
+            raise ValueError('Duration must be between 1 and 365 days')
+    except ValueError as e:
+        parser.error(str(e))
+    if len(thresholds) == 0:
+        parser.error('Give more than one value for at least one variable to sweep')
+    results = sweep.threshold_sweep(parameters, thresholds, args.days)
+    if args.output is None:
+        write_sweep(results, args.format, sys.stdout)
+    else:
+        with open(args.output, 'w', newline='') as file:
+            write_sweep(results, args.format, file)
+
+
+def _run_query(args, parser):
+    stations = resources.get_all_stations()
+    try:
+        station = 0 if args.all_stations else resolve_station(args.station, stations)
+        parameters = build_parameters(station, args.temperature, args.precipitation, args.wind, args.days, args.months,
+                                      args.percentile, args.by_month)
+    except ValueError as e:
+        parser.error(str(e))
+    timer = None
+    if args.timings or args.profile is not None:
+        if args.all_stations and args.workers > 1:
+            parser.error('--timings and --profile cannot be used with more than one worker')
+        logging.basicConfig(level=logging.DEBUG if args.timings else logging.INFO, format='%(message)s')
+        timer = profiling.StageTimer(trace_memory=args.timings, profile_path=args.profile)
+    if args.export is not None:
+        try:
+            export_format = export.format_from_path(args.export)
+        except ValueError as e:
+            parser.error(str(e))
+        if export_format == 'parquet' and export.pyarrow is None:
+            parser.error('Exporting to Parquet needs the pyarrow package')
+        if args.statistics or args.output is not None:
+            parser.error('--export cannot be used with --statistics or --output')
+        if args.all_stations and args.workers > 1:
+            parser.error('--export cannot be used with more than one worker')
+    if args.result_cache is not None:
+        result_cache.cache.open_disk(args.result_cache)
+    with profiling.timing(timer):
+        if args.export is not None:
+            # Events are written a batch at a time as they are found, rather than collected first
+            if args.all_stations:
+                batches = query.iter_batch_query(parameters, timer=timer)
+            else:
+                batches = export.station_batches(station, query.iter_query(parameters, timer=timer))
+            export.export_events(batches, args.export, stations=stations)
+            return
+        if args.all_stations:
+            if args.workers > 1:
+                results = parallel.parallel_batch_query(parameters, workers=args.workers)
+            else:
+                results = query.batch_query(parameters, timer=timer)
+        else:
+            results = {station: query.run_query(parameters, timer=timer)}
+    write = write_statistics if args.statistics else write_results
+    if args.output is None:
+        write(results, stations, args.format, sys.stdout)
+    else:
+        with open(args.output, 'w', newline='') as file:
+            write(results, stations, args.format, file)
+
+
+def _run_server(args, parser):
+    stations = resources.get_all_stations()
+    try:
+        warm = [resolve_station(station, stations) for station in args.warm]
+    except ValueError as e:
+        parser.error(str(e))
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s",
+                        datefmt="%Y-%m-%d  %H:%M:%S")
+    if args.result_cache is not None:
+        result_cache.cache.open_disk(args.result_cache)
+    server.serve(args.host, args.port, args.workers, warm, args.percentiles)
+
+
+def main(argv=None):
+    parser = _create_parser()
+    args = parser.parse_args(argv)
+    if args.command == 'query':
+        _run_query(args, parser)
+    elif args.command == 'sweep':
+        _run_sweep(args, parser)
+    elif args.command == 'serve':
+        _run_server(args, parser)
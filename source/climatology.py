@@ -0,0 +1,191 @@
+import argparse
+import logging
+import os
+import threading
+import numpy
+from source import data, resources, station_store
+
+"""
+Per-station climatology, used to express thresholds as percentiles of a station's own record (for example, temperature
+above the station's 95th percentile).
+
+A table of the 0th to 100th percentiles of every variable at every station, over the whole year and for each calendar
+month, is built once from the data and stored next to it. At query time a threshold at a whole percentile is a lookup
+in this table. Other percentiles are calculated from the station's data, as interpolating between whole percentiles
+would not give the station's true quantile. The table is rebuilt if the data files change, or does not hold the stations
+asked for.
+"""
+
+# Increase when the layout of the table changes, so that tables built by older versions are rebuilt
+CLIMATOLOGY_VERSION = 1
+
+# The percentiles stored in the table
+PERCENTILES = numpy.arange(101)
+
+# Number of stations loaded at a time while building the table
+BUILD_CHUNK_SIZE = 64
+
+logger = logging.getLogger(__name__)
+
+_table = None
+_table_lock = threading.Lock()
+
+
+# Returns the default location of the table
+def default_climatology_path():
+    return resources.data_path('climatology.npz')
+
+
+# Calculates percentiles along the last axis, ignoring NaN, with linear interpolation between values (the same as
+# numpy.nanpercentile, but vectorized across rows). Rows with no values give NaN.
+# Returns an array with the percentiles on the last axis
+def quantiles(values, percentiles):
+    values = numpy.sort(values, axis=-1)
+    percentiles = numpy.asarray(percentiles, dtype=numpy.float64)
+    counts = numpy.sum(~numpy.isnan(values), axis=-1, keepdims=True)
+    positions = percentiles / 100 * numpy.maximum(counts - 1, 0)
+    lower = numpy.floor(positions).astype(numpy.int64)
+    upper = numpy.minimum(lower + 1, numpy.maximum(counts - 1, 0))
+    fraction = positions - lower
+    lower_values = numpy.take_along_axis(values, lower, axis=-1)
+    upper_values = numpy.take_along_axis(values, upper, axis=-1)
+    result = lower_values + (upper_values - lower_values) * fraction
+    return numpy.where(counts > 0, result, numpy.nan)
+
+
+# Calculates the percentiles of each row over the whole record and over each calendar month.
+#   months: (time,) array of the calendar month (1-12) of each day
+# Returns a (row, 13, percentiles) array, where index 0 of the second axis is the whole year and 1-12 are the months
+def monthly_quantiles(values, months, percentiles):
+    result = numpy.empty(values.shape[:-1] + (13, len(percentiles)), dtype=numpy.float64)
+    result[..., 0, :] = quantiles(values, percentiles)
+    for month in range(1, 13):
+        result[..., month, :] = quantiles(values[..., months == month], percentiles)
+    return result
+
+
+# Builds the table from the data, one chunk of stations at a time
+def build_climatology(path=None, chunk_size=BUILD_CHUNK_SIZE):
+    path = default_climatology_path() if path is None else path
+    logger.info('Building climatology in ' + path)
+    fingerprint = data.data_fingerprint()
+    tables = []
+    regions = []
+    for chunk in station_store.iter_station_chunks(chunk_size):
+        months = chunk['time.month'].values
+        tables.append(numpy.stack([
+            monthly_quantiles(chunk[variable].transpose('region', 'time').values, months, PERCENTILES)
+            for variable in data.VARIABLES
+        ]).astype(numpy.float32))
+        regions.append(chunk.region.values)
+        chunk.close()
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as file:
+        numpy.savez(file, version=CLIMATOLOGY_VERSION, fingerprint=fingerprint, variables=data.VARIABLES,
+                    region=numpy.concatenate(regions), quantiles=numpy.concatenate(tables, axis=1))
+    os.replace(temp_path, path)
+    logger.info('Climatology complete')
+
+
+# Returns the table for the current data, as a dict with 'region' and 'quantiles' (variable, region, 13, percentile).
+# The table is read from disk once per process, and built first if it is missing or out of date, or if rebuild is True.
+def load_climatology(path=None, rebuild=False):
+    global _table
+    path = default_climatology_path() if path is None else path
+    fingerprint = data.data_fingerprint()
+    with _table_lock:
+        if not rebuild and _table is not None and _table['path'] == path and _table['fingerprint'] == fingerprint:
+            return _table
+        table = None if rebuild else _read_table(path)
+        if table is None or table['fingerprint'] != fingerprint:
+            build_climatology(path)
+            table = _read_table(path)
+        table['path'] = path
+        _table = table
+        return _table
+
+
+def _read_table(path):
+    try:
+        with numpy.load(path) as file:
+            if int(file['version']) != CLIMATOLOGY_VERSION or list(file['variables']) != data.VARIABLES:
+                return None
+            return {
+                'fingerprint': str(file['fingerprint']),
+                'region': file['region'],
+                'quantiles': file['quantiles']
+            }
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+# Interpolates a percentile (0-100) from a table whose last axis holds the whole percentiles 0 to 100
+def _interpolate(table, percentile):
+    if not 0 <= percentile <= 100:
+        raise ValueError('Percentile must be between 0 and 100')
+    lower = min(int(numpy.floor(percentile)), 99)
+    fraction = percentile - lower
+    return table[..., lower] + (table[..., lower + 1] - table[..., lower]) * fraction
+
+
+# Returns the row of each of the given stations in the table, or None if any of them is not in it
+def _table_positions(table, regions):
+    regions = numpy.asarray(regions)
+    order = numpy.argsort(table['region'], kind='stable')
+    found = numpy.searchsorted(table['region'], regions, sorter=order)
+    if numpy.any(found >= order.size):
+        return None
+    positions = order[found]
+    if not numpy.array_equal(table['region'][positions], regions):
+        return None
+    return positions
+
+
+# Looks up the value of a percentile of a data variable at each of the given stations. Percentiles between the whole
+# percentiles in the table are interpolated; use station_percentiles for the stations' true quantiles.
+#   variable: name of the data variable, one of data.VARIABLES
+#   regions: station identifiers (values of the region coordinate)
+#   by_month: if True, give the percentile of each calendar month separately
+# Returns a (region,) array, or a (region, 12) array if by_month
+def percentile_thresholds(variable, regions, percentile, by_month=False):
+    table = load_climatology()
+    positions = _table_positions(table, regions)
+    if positions is None:
+        # The table does not hold every station in the data it was built from, so build it again
+        table = load_climatology(rebuild=True)
+        positions = _table_positions(table, regions)
+        if positions is None:
+            raise KeyError('Stations are missing from the climatology table: {}'.format(
+                numpy.setdiff1d(regions, table['region']).tolist()))
+    rows = table['quantiles'][data.VARIABLES.index(variable), positions].astype(numpy.float64)
+    if by_month:
+        return _interpolate(rows[:, 1:], percentile)
+    return _interpolate(rows[:, 0], percentile)
+
+
+# Returns the value of a percentile of a data variable at each station in dataset, which must hold each station's whole
+# record, in the same form as percentile_thresholds. Whole percentiles are looked up in the table, and others are
+# calculated from the data.
+def station_percentiles(dataset, variable, percentile, by_month=False):
+    if float(percentile).is_integer():
+        return percentile_thresholds(variable, dataset.region.values, percentile, by_month)
+    values = dataset[variable].transpose('region', 'time').values
+    return percentile_of(values, percentile, dataset['time.month'].values, by_month)
+
+
+# Calculates the value of a percentile of each row of values directly, for series that are not in the table, such as
+# precipitation accumulated over several days.
+#   months: (time,) array of the calendar month (1-12) of each day, required if by_month
+# Returns a (row,) array, or a (row, 12) array if by_month
+def percentile_of(values, percentile, months=None, by_month=False):
+    if by_month:
+        return monthly_quantiles(values, months, [percentile])[..., 1:, 0]
+    return quantiles(values, [percentile])[..., 0]
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s",
+                        datefmt="%Y-%m-%d  %H:%M:%S")
+    parser = argparse.ArgumentParser(description='Build the per-station percentile table from the data in data/')
+    parser.add_argument('--path', default=None, help='File to write the table to (default: data/climatology.npz)')
+    build_climatology(parser.parse_args().path)
@@ -0,0 +1,80 @@
+import xarray
+import numpy
+import hashlib
+import os
+from source.resources import data_path
+
+# The netCDF files that drive this tool, in the order they are opened. Each holds one variable of the same name on a
+# (region, time) grid.
+VARIABLES = ['minimum_temperature', 'maximum_temperature', 'precipitation', 'windspeed']
+
+# A single netCDF file holding all four variables, as written by `python -m source.repack --merge`. If present in the
+# data directory, it is read instead of the separate files.
+MERGED_FILE = 'all_variables.nc'
+
+
+# Returns the absolute paths of the netCDF files for every variable
+def data_files():
+    merged = data_path(MERGED_FILE)
+    if os.path.exists(merged):
+        return [merged]
+    return [data_path(variable + '.nc') for variable in VARIABLES]
+
+
+# Identifies the current contents of the data directory without reading the files. Changes whenever any netCDF file is
+# replaced, resized or modified, so anything derived from the data can tell when it needs to be rebuilt.
+# Returns a hex digest
+def data_fingerprint():
+    digest = hashlib.sha256()
+    for path in data_files():
+        stat = os.stat(path)
+        digest.update('{}:{}:{};'.format(os.path.basename(path), stat.st_size, stat.st_mtime_ns).encode())
+    return digest.hexdigest()
+
+
+# Opens all four netCDF files as one lazy dataset. No values are read until they are selected and loaded.
+def open_dataset():
+    return xarray.open_mfdataset(data_files(), join='override')
+
+
+# Finds the position of a station along the region dimension. Stations are identified by the value of the region
+# coordinate, which is the station's index in data/locations.txt.
+def station_position(data, station):
+    positions = numpy.flatnonzero(data.region.values == station)
+    if positions.size == 0:
+        raise KeyError('Station {} is not in the dataset'.format(station))
+    return int(positions[0])
+
+
+# Returns the number of stations along the region dimension. Only reads metadata.
+def station_count():
+    with open_dataset() as data:
+        return data.region.size
+
+
+# Loads the data for a single station into memory. The station is selected by position before any values are read, so
+# only that station's rows are pulled from disk rather than masking every region.
+#   cancelled: optional threading.Event. Variables are read one at a time, and reading stops once the event is set.
+#   progress: optional function called with the fraction (0-1) of the variables read, as each one is read
+# Returns a Dataset with a region dimension of length 1, or None if cancelled.
+def load_station(station, cancelled=None, progress=None):
+    with open_dataset() as data:
+        station_data = data.isel(region=[station_position(data, station)])
+        for i, variable in enumerate(VARIABLES):
+            if cancelled is not None and cancelled.is_set():
+                return None
+            station_data[variable].load()
+            if progress is not None:
+                progress((i + 1) / len(VARIABLES))
+        return station_data.load()
+
+
+# Loads stations in chunks of consecutive positions along the region dimension, so that every station can be processed
+# while only `chunk_size` of them are held in memory. Covers positions from start up to (not including) stop.
+# Yields Datasets with a region dimension of up to chunk_size
+def iter_station_chunks(chunk_size, start=0, stop=None):
+    with open_dataset() as data:
+        stop = data.region.size if stop is None else min(stop, data.region.size)
+        for chunk_start in range(start, stop, chunk_size):
+            yield data.isel(region=slice(chunk_start, min(chunk_start + chunk_size, stop))).load()
+
@@ -1,41 +1,110 @@
-import threading
+import calendar
 import tkinter
+from tkinter import ttk, font
 
 
-class ThreadedDisplayResults(threading.Thread):
-    def __init__(self, queue, results, window):
-        threading.Thread.__init__(self)
-        self.queue = queue
+# Formats dates for display in the results table, as DD-MM-YYYY. Takes YYYY-MM-DD strings.
+def format_dates(iso_dates):
+    return [date[8:10] + '-' + date[5:7] + '-' + date[:4] for date in iso_dates]
+
+
+# Describes the results of a query in a few sentences, from the statistics returned by events.event_statistics
+def format_summary(statistics):
+    text = 'The specified conditions have occurred {} times over {} years ({}-{})'.format(
+        statistics['events'], statistics['years'], statistics['first_year'], statistics['last_year'])
+    if statistics['events'] == 0:
+        return text + '.'
+    if statistics['events_per_year'] >= 1:
+        text += ', {:.1f} times a year on average.'.format(statistics['events_per_year'])
+    else:
+        text += ', about once every {:.1f} years.'.format(statistics['return_period'])
+    text += ' Events lasted {:.1f} days on average, and up to {} days.'.format(statistics['mean_duration'],
+                                                                             statistics['max_duration'])
+    text += ' At least one occurred in {} of the {} years.'.format(statistics['years_with_events'], statistics['years'])
+    month = max(range(12), key=lambda i: statistics['per_month'][i])
+    decade = max(range(len(statistics['decades'])), key=lambda i: statistics['per_decade'][i])
+    text += ' Most began in {}, and the {}s had the most ({}).'.format(
+        calendar.month_name[month + 1], statistics['decades'][decade], statistics['per_decade'][decade])
+    return text
+
+
+# A table of start and end dates that only ever holds the rows currently in view. Scrolling moves a window over the list
+# of results and refills those rows, so displaying 100,000 events costs the same as displaying 10. Results are an
+# events.EventList, and only the dates in view are formatted, all at once. All methods must be called from the main
+# thread.
+class ResultsTable(tkinter.Frame):
+    def __init__(self, master, **kwargs):
+        tkinter.Frame.__init__(self, master, **kwargs)
+        self.results = []
+        self.offset = 0
+        self.visible_rows = 1
+        self.items = []
+
+        self.row_height = font.nametofont('TkDefaultFont').metrics('linespace') + 6
+        ttk.Style(self).configure('Results.Treeview', rowheight=self.row_height)
+        self.tree = ttk.Treeview(self, columns=('start_date', 'end_date'), show='headings', selectmode='none',
+                                 style='Results.Treeview', height=1)
+        self.tree.heading('start_date', text='Start Date', anchor='w')
+        self.tree.heading('end_date', text='End Date', anchor='w')
+        self.tree.column('start_date', width=100, anchor='w')
+        self.tree.column('end_date', width=100, anchor='w')
+        self.scrollbar = tkinter.Scrollbar(self, orient='vertical', command=self.yview)
+
+        self.rowconfigure(0, weight=1)
+        self.columnconfigure(0, weight=1)
+        self.tree.grid(row=0, column=0, sticky='nsew')
+        self.scrollbar.grid(row=0, column=1, sticky='ns')
+        self.tree.bind('<Configure>', self._on_configure)
+
+    # Shows a new events.EventList, scrolled to the top
+    def set_results(self, results):
         self.results = results
-        self.window = window
-
-    def run(self):
-        # Fallback in case of error during processing - clear the table
-        if self.results is None:
-            self.window.close_popup()
-            return
-
-        # Repurpose Labels if existing. If more Labels than required, hide them temporarily.
-        for i, result in enumerate(self.results):
-            start_date = '%02d-%02d-%d' % (result[0].year, result[0].month, result[0].day)
-            end_date = '%02d-%02d-%d' % (result[1].year, result[1].month, result[1].day)
-            if len(self.window.entries) <= i:
-                self.window.entries.append([])
-                self.window.entries[i].append(tkinter.Label(master=self.window.scrollable_frame, text=start_date,
-                                                            borderwidth=1, relief='ridge', anchor='w', padx=10,
-                                                            bg='white'))
-                self.window.entries[i].append(tkinter.Label(master=self.window.scrollable_frame, text=end_date,
-                                                            borderwidth=1, relief='ridge', anchor='w', padx=10,
-                                                            bg='white'))
-            else:
-                self.window.entries[i][0]['text'] = start_date
-                self.window.entries[i][1]['text'] = end_date
-            self.window.entries[i][0].grid(row=i + 1, column=0, sticky='nsew')
-            self.window.entries[i][1].grid(row=i + 1, column=1, sticky='nsew')
-        if len(self.window.entries) > len(self.results):
-            for i in range(len(self.results), len(self.window.entries)):
-                self.window.entries[i][0].grid_forget()
-                self.window.entries[i][1].grid_forget()
-        self.window.results_canvas.yview_moveto(0)
-        self.window.active_canvas = self.window.results_canvas
-        self.window.close_popup()
+        self.offset = 0
+        self.refresh()
+
+    # Removes all results from the table
+    def clear(self):
+        self.set_results([])
+
+    # Redraws the rows in view
+    def refresh(self):
+        rows = self.results[self.offset:self.offset + self.visible_rows]
+        while len(self.items) > len(rows):
+            self.tree.delete(self.items.pop())
+        while len(self.items) < len(rows):
+            self.items.append(self.tree.insert('', 'end'))
+        if len(rows) > 0:
+            start_dates, end_dates = rows.iso_dates()
+            for item, start_date, end_date in zip(self.items, format_dates(start_dates), format_dates(end_dates)):
+                self.tree.item(item, values=(start_date, end_date))
+        if len(self.results) == 0:
+            self.scrollbar.set(0, 1)
+        else:
+            self.scrollbar.set(self.offset / len(self.results), (self.offset + len(rows)) / len(self.results))
+
+    # Scrollbar command. Accepts the same arguments as the yview method of Tk's scrollable widgets.
+    def yview(self, *args):
+        if args[0] == 'moveto':
+            self.yview_moveto(float(args[1]))
+        elif args[0] == 'scroll':
+            self.yview_scroll(int(args[1]), args[2])
+
+    def yview_moveto(self, fraction):
+        self._scroll_to(int(round(fraction * len(self.results))))
+
+    def yview_scroll(self, number, what):
+        self._scroll_to(self.offset + number * (self.visible_rows if what == 'pages' else 1))
+
+    def _scroll_to(self, offset):
+        self.offset = max(0, min(offset, len(self.results) - self.visible_rows))
+        self.refresh()
+
+    # Works out how many rows fit in the table whenever it is resized
+    def _on_configure(self, event):
+        heading_height = self.row_height
+        if len(self.items) > 0:
+            bbox = self.tree.bbox(self.items[0])
+            if bbox:
+                heading_height = bbox[1]
+        self.visible_rows = max(1, (event.height - heading_height) // self.row_height)
+        self._scroll_to(self.offset)
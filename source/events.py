@@ -0,0 +1,230 @@
+import numpy
+import pandas
+
+"""
+Vectorized detection of extreme events in daily series.
+
+Conditions arrive as boolean arrays over the time axis, one value per day, either for a single station (time,) or for
+many stations at once (station, time). Events are returned as arrays of start and end indices into that time axis (both
+inclusive), so the caller can convert them to dates in one step. Query results keep this form (see EventList), and
+dates are only created for the events that are actually displayed or exported.
+"""
+
+# Number of events converted to dates at a time when iterating over an EventList
+ITERATION_CHUNK_SIZE = 1000
+
+
+# A list of events, stored as int32 start and end indices (both inclusive) into a time axis shared by every event. Each
+# event costs 8 bytes, rather than a pair of Timestamp objects. Behaves as a read-only sequence of
+# (start_date: Pandas Timestamp, end_date: Pandas Timestamp) tuples, creating them only for the events accessed.
+# Slicing returns another EventList without copying.
+class EventList:
+    def __init__(self, time, starts, ends):
+        self.time = time
+        self.starts = numpy.asarray(starts, dtype=numpy.int32)
+        self.ends = numpy.asarray(ends, dtype=numpy.int32)
+
+    def __len__(self):
+        return self.starts.size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return EventList(self.time, self.starts[index], self.ends[index])
+        return pandas.Timestamp(self.time[self.starts[index]]), pandas.Timestamp(self.time[self.ends[index]])
+
+    def __iter__(self):
+        for i in range(0, len(self), ITERATION_CHUNK_SIZE):
+            chunk = self[i:i + ITERATION_CHUNK_SIZE]
+            yield from zip(pandas.to_datetime(chunk.start_dates()), pandas.to_datetime(chunk.end_dates()))
+
+    # Joins two lists of events on the same time axis
+    def __add__(self, other):
+        return EventList(self.time, numpy.concatenate((self.starts, other.starts)),
+                         numpy.concatenate((self.ends, other.ends)))
+
+    # Lists of events are equal if they hold the same dates, even if their time axes are separate arrays
+    def __eq__(self, other):
+        if not isinstance(other, EventList):
+            return NotImplemented
+        return bool(numpy.array_equal(self.start_dates(), other.start_dates()) and
+                    numpy.array_equal(self.end_dates(), other.end_dates()))
+
+    def __repr__(self):
+        return 'EventList({} events)'.format(len(self))
+
+    # Returns the start dates as a datetime64 array
+    def start_dates(self):
+        return self.time[self.starts]
+
+    # Returns the end dates as a datetime64 array
+    def end_dates(self):
+        return self.time[self.ends]
+
+    # Formats every start and end date at once, as YYYY-MM-DD strings.
+    # Returns (start_dates, end_dates) as arrays of strings
+    def iso_dates(self):
+        return (numpy.datetime_as_string(self.start_dates(), unit='D'),
+                numpy.datetime_as_string(self.end_dates(), unit='D'))
+
+    # Returns aggregate statistics for these events, as described in event_statistics
+    def statistics(self):
+        return event_statistics(self.time, self.starts, self.ends)
+
+
+# Summarizes events over the years covered by their time axis, counting each event in the year, decade and month in
+# which it starts. Works from the start and end indices alone, so the data is not read again.
+#   time: datetime64 array of the days that starts and ends index
+#
+# Returns {} with plain Python values (so it can be written as JSON):
+#   events: number of events
+#   first_year, last_year: the calendar years covered by the time axis
+#   years: number of calendar years covered
+#   per_year: [] number of events starting in each year, from first_year to last_year
+#   decades: [] first year of each decade covered (1880, 1890, ...)
+#   per_decade: [] number of events starting in each decade
+#   per_month: [] number of events starting in each calendar month, January first
+#   events_per_year: average number of events a year
+#   mean_duration, max_duration: length of the events in days, or None if there are none
+#   return_period: average number of years between events, or None if there are none
+#   years_with_events: number of years in which at least one event starts
+#   annual_return_period: average number of years between years with at least one event, or None if there are none
+def event_statistics(time, starts, ends):
+    first_year = int(time[0].astype('datetime64[Y]').astype(numpy.int64)) + 1970
+    last_year = int(time[-1].astype('datetime64[Y]').astype(numpy.int64)) + 1970
+    years = last_year - first_year + 1
+    start_dates = time[starts]
+    start_years = start_dates.astype('datetime64[Y]').astype(numpy.int64) + 1970
+    start_months = start_dates.astype('datetime64[M]').astype(numpy.int64) % 12
+    per_year = numpy.bincount(start_years - first_year, minlength=years)
+    first_decade = first_year // 10 * 10
+    decades = numpy.arange(first_decade, last_year + 1, 10)
+    per_decade = numpy.bincount(start_years // 10 - first_decade // 10, minlength=decades.size)
+    durations = numpy.asarray(ends, dtype=numpy.int64) - starts + 1
+    years_with_events = int(numpy.count_nonzero(per_year))
+    return {
+        'events': int(starts.size),
+        'first_year': first_year,
+        'last_year': last_year,
+        'years': years,
+        'per_year': per_year.tolist(),
+        'decades': decades.tolist(),
+        'per_decade': per_decade.tolist(),
+        'per_month': numpy.bincount(start_months, minlength=12).tolist(),
+        'events_per_year': starts.size / years,
+        'mean_duration': float(durations.mean()) if starts.size > 0 else None,
+        'max_duration': int(durations.max()) if starts.size > 0 else None,
+        'return_period': years / starts.size if starts.size > 0 else None,
+        'years_with_events': years_with_events,
+        'annual_return_period': years / years_with_events if years_with_events > 0 else None
+    }
+
+
+# Finds every run of consecutive True values along the last axis of a (station, time) array.
+# Returns (stations, starts, ends) as index arrays, with ends inclusive, ordered by station then start
+def find_runs(mask):
+    mask = numpy.atleast_2d(mask)
+    padded = numpy.zeros((mask.shape[0], mask.shape[1] + 2), dtype=numpy.int8)
+    padded[:, 1:-1] = mask
+    changes = numpy.diff(padded, axis=1)
+    stations, starts = numpy.nonzero(changes == 1)
+    _, ends = numpy.nonzero(changes == -1)
+    return stations, starts, ends - 1
+
+
+# For each day, counts how many consecutive days up to and including that day are True. Days that are False count 0.
+# Works along the last axis.
+def run_length_to_date(mask):
+    mask = numpy.asarray(mask, dtype=bool)
+    index = numpy.broadcast_to(numpy.arange(mask.shape[-1]), mask.shape)
+    last_false = numpy.maximum.accumulate(numpy.where(mask, -1, index), axis=-1)
+    return numpy.where(mask, index - last_false, 0)
+
+
+# Sums each day with the `window - 1` days before it, along the last axis, as the difference of two prefix sums. The
+# cost is the same for any window length. Missing (NaN) days are skipped, and windows at the start of the series are
+# shorter, so a sum is NaN only if every day in its window is missing (the same as a rolling sum with min_periods=1).
+#   skip: (time,) bool array of days to treat as missing, or None
+# Returns a float64 array of the same shape as values
+def rolling_sum(values, window, skip=None):
+    values = numpy.asarray(values, dtype=numpy.float64)
+    valid = ~numpy.isnan(values)
+    if skip is not None:
+        valid &= ~skip
+    shape = values.shape[:-1] + (values.shape[-1] + 1,)
+    sums = numpy.zeros(shape, dtype=numpy.float64)
+    numpy.cumsum(numpy.where(valid, values, 0), axis=-1, out=sums[..., 1:])
+    counts = numpy.zeros(shape, dtype=numpy.int64)
+    numpy.cumsum(valid, axis=-1, out=counts[..., 1:])
+    window_starts = numpy.maximum(numpy.arange(values.shape[-1]) - window + 1, 0)
+    totals = sums[..., 1:] - sums[..., window_starts]
+    return numpy.where(counts[..., 1:] > counts[..., window_starts], totals, numpy.nan)
+
+
+# Greedily picks candidates from the earliest onwards, skipping any that fall within `spacing` days of the last one
+# picked. Candidates must be sorted. Candidates on consecutive days form blocks, and within a block the picks are simply
+# every `spacing` days, so this loops once per block containing a pick rather than once per day.
+def select_spaced(candidates, spacing):
+    if candidates.size == 0:
+        return numpy.empty(0, dtype=numpy.int64)
+    breaks = numpy.flatnonzero(numpy.diff(candidates) != 1)
+    block_ends = numpy.append(candidates[breaks], candidates[-1])
+    selected = []
+    i = 0
+    while i < candidates.size:
+        first = candidates[i]
+        last = block_ends[numpy.searchsorted(block_ends, first)]
+        selected.append(numpy.arange(first, last + 1, spacing, dtype=numpy.int64))
+        i = numpy.searchsorted(candidates, selected[-1][-1] + spacing, side='left')
+    return numpy.concatenate(selected)
+
+
+# Applies select_spaced to each station independently. Stations are laid end to end with a gap of at least `spacing`
+# days between them, so a pick at the end of one station never excludes a candidate at the start of the next.
+# Returns (stations, indices)
+def select_spaced_by_station(candidates, spacing):
+    candidates = numpy.atleast_2d(candidates)
+    stride = candidates.shape[1] + spacing
+    stations, indices = numpy.nonzero(candidates)
+    selected = select_spaced(stations.astype(numpy.int64) * stride + indices, spacing)
+    return selected // stride, selected % stride
+
+
+# Finds events that satisfy the conditions for at least `consecutive_days` days, for each station.
+#   condition: (station, time) bool array of days that meet the temperature and wind conditions, or None if neither is
+#              queried
+#   precipitation: (station, time) bool array of days where the accumulated precipitation ending that day meets the
+#                  precipitation condition, or None if precipitation is not queried
+#   month_mask: (time,) bool array of days outside of the selected months, or None if months are not filtered
+#
+# Temperature and wind only: each run of at least `consecutive_days` qualifying days is one event.
+# Precipitation only: each day meeting the condition ends a window of `consecutive_days` days, provided the first and
+#   last day of the window fall in the selected months. After an event, the next `consecutive_days` days are skipped.
+# Combined: a window of `consecutive_days` qualifying days is an event if the precipitation condition is met on its last
+#   day. Otherwise the window slides along one day. Events do not overlap.
+#
+# Returns (stations, starts, ends) as index arrays, with ends inclusive, ordered by station then start
+def find_station_events(condition, precipitation, consecutive_days, month_mask=None):
+    if precipitation is None:
+        if condition is None:
+            raise ValueError('No conditions to search for')
+        stations, starts, ends = find_runs(condition)
+        long_enough = ends - starts + 1 >= consecutive_days
+        return stations[long_enough], starts[long_enough], ends[long_enough]
+    precipitation = numpy.atleast_2d(precipitation)
+    if condition is None:
+        candidates = precipitation
+        if month_mask is not None:
+            window_starts = numpy.maximum(numpy.arange(month_mask.size) - consecutive_days + 1, 0)
+            candidates = candidates & ~(month_mask[window_starts] | month_mask)
+        stations, ends = select_spaced_by_station(candidates, consecutive_days + 1)
+        return stations, numpy.maximum(ends - consecutive_days + 1, 0), ends
+    candidates = precipitation & (run_length_to_date(numpy.atleast_2d(condition)) >= consecutive_days)
+    stations, ends = select_spaced_by_station(candidates, consecutive_days)
+    return stations, ends - consecutive_days + 1, ends
+
+
+# Finds events for a single station. Takes the same arguments as find_station_events, with (time,) condition arrays.
+# Returns (starts, ends) as index arrays, with ends inclusive
+def find_events(condition, precipitation, consecutive_days, month_mask=None):
+    _, starts, ends = find_station_events(condition, precipitation, consecutive_days, month_mask)
+    return starts, ends
@@ -0,0 +1,174 @@
+import csv
+import os
+import shutil
+import tempfile
+import dask.array
+import numpy
+import xarray
+from utils import save_to_netcdf
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    # Only needed for Parquet output
+    pyarrow = None
+
+"""
+Exports events found by queries to CSV, Parquet or netCDF files, for a single station or every station.
+
+Events are written as they arrive, a batch at a time, so exporting millions of events across all stations never holds
+them all in memory. Every format has the same columns, one row per event:
+    station: the station's index
+    name: the station's name (only if station names are given)
+    start_date, end_date: first and last day of the event
+    duration: length of the event in days
+
+Parquet files store the dates as date columns, and need the pyarrow package. netCDF files are written through
+utils.save_to_netcdf, which compresses each variable and logs progress. As a netCDF variable's length must be known
+before it is written, events are first staged in temporary files next to the output, then written from there in chunks.
+"""
+
+FORMATS = {'.csv': 'csv', '.parquet': 'parquet', '.nc': 'netcdf'}
+
+# Number of events per chunk when writing netCDF files
+NETCDF_CHUNK_SIZE = 1000000
+
+# Reference date for the dates stored in netCDF files, as days since this date
+NETCDF_EPOCH = numpy.datetime64('1970-01-01', 'D')
+
+
+# Works out the output format from a file name, by its extension
+# Returns 'csv', 'parquet' or 'netcdf'
+def format_from_path(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in FORMATS:
+        raise ValueError('Cannot tell the format of {}. Use one of: {}'.format(path, ', '.join(FORMATS)))
+    return FORMATS[extension]
+
+
+# Writes events to a file as they are produced.
+#   batches: iterable of {} of station index to events.EventList, such as the batches yielded by
+#            query.iter_batch_query. For a single station, see station_batches.
+#   output_format: 'csv', 'parquet' or 'netcdf', or None to choose from the extension of path
+#   stations: optional list of station names, indexed by station, to include a name column
+# Returns the number of events written
+def export_events(batches, path, output_format=None, stations=None):
+    output_format = format_from_path(path) if output_format is None else output_format
+    if output_format == 'csv':
+        return _export_csv(batches, path, stations)
+    if output_format == 'parquet':
+        return _export_parquet(batches, path, stations)
+    if output_format == 'netcdf':
+        return _export_netcdf(batches, path)
+    raise ValueError('Unknown export format: ' + output_format)
+
+
+# Wraps results for a single station, such as those yielded by query.iter_query, as batches for export_events
+def station_batches(station, results):
+    for events in results:
+        yield {station: events}
+
+
+# Returns the columns for the events at one station: (station, start_dates, end_dates, durations), as arrays
+def _columns(station, events):
+    start_dates = events.start_dates().astype('datetime64[D]')
+    end_dates = events.end_dates().astype('datetime64[D]')
+    durations = (end_dates - start_dates).astype(numpy.int32) + 1
+    return numpy.full(len(events), station, dtype=numpy.int32), start_dates, end_dates, durations
+
+
+def _names(stations, station, count):
+    return [stations[station] if station < len(stations) else ''] * count
+
+
+def _export_csv(batches, path, stations):
+    written = 0
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file, lineterminator='\n')
+        writer.writerow(['station'] + (['name'] if stations is not None else []) +
+                        ['start_date', 'end_date', 'duration'])
+        for batch in batches:
+            for station, events in batch.items():
+                if len(events) == 0:
+                    continue
+                start_dates, end_dates = events.iso_dates()
+                durations = (events.ends - events.starts + 1).tolist()
+                columns = [[station] * len(events)]
+                if stations is not None:
+                    columns.append(_names(stations, station, len(events)))
+                columns += [start_dates.tolist(), end_dates.tolist(), durations]
+                writer.writerows(zip(*columns))
+                written += len(events)
+    return written
+
+
+def _export_parquet(batches, path, stations):
+    if pyarrow is None:
+        raise ImportError('Exporting to Parquet needs the pyarrow package')
+    fields = [('station', pyarrow.int32())]
+    if stations is not None:
+        fields.append(('name', pyarrow.string()))
+    fields += [('start_date', pyarrow.date32()), ('end_date', pyarrow.date32()), ('duration', pyarrow.int32())]
+    schema = pyarrow.schema(fields)
+    written = 0
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        for batch in batches:
+            for station, events in batch.items():
+                if len(events) == 0:
+                    continue
+                station_column, start_dates, end_dates, durations = _columns(station, events)
+                columns = [pyarrow.array(station_column)]
+                if stations is not None:
+                    columns.append(pyarrow.array(_names(stations, station, len(events)), type=pyarrow.string()))
+                columns += [pyarrow.array(start_dates, type=pyarrow.date32()),
+                            pyarrow.array(end_dates, type=pyarrow.date32()), pyarrow.array(durations)]
+                writer.write_table(pyarrow.Table.from_arrays(columns, schema=schema))
+                written += len(events)
+    return written
+
+
+# Stages each column in a raw binary file as batches arrive, then writes the netCDF file from memory maps of those files
+# in chunks of NETCDF_CHUNK_SIZE events. Dates are stored as days since NETCDF_EPOCH, with CF units, so they are read
+# back as dates.
+def _export_netcdf(batches, path):
+    names = ['station', 'start_date', 'end_date', 'duration']
+    staging = tempfile.mkdtemp(prefix='export-', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        files = {name: open(os.path.join(staging, name), 'wb') for name in names}
+        written = 0
+        try:
+            for batch in batches:
+                for station, events in batch.items():
+                    station_column, start_dates, end_dates, durations = _columns(station, events)
+                    station_column.tofile(files['station'])
+                    (start_dates - NETCDF_EPOCH).astype(numpy.int32).tofile(files['start_date'])
+                    (end_dates - NETCDF_EPOCH).astype(numpy.int32).tofile(files['end_date'])
+                    durations.tofile(files['duration'])
+                    written += len(events)
+        finally:
+            for file in files.values():
+                file.close()
+
+        variables = {}
+        for name in names:
+            if written == 0:
+                values = numpy.empty(0, dtype=numpy.int32)
+            else:
+                values = numpy.memmap(os.path.join(staging, name), dtype=numpy.int32, mode='r', shape=(written,))
+            variables[name] = ('event', dask.array.from_array(values, chunks=NETCDF_CHUNK_SIZE))
+        dataset = xarray.Dataset(variables)
+        for name in ['start_date', 'end_date']:
+            dataset[name].attrs = {'units': 'days since {}'.format(NETCDF_EPOCH), 'calendar': 'standard'}
+        dataset['station'].attrs['long_name'] = 'station index'
+        dataset['duration'].attrs = {'long_name': 'length of the event', 'units': 'days'}
+        if os.path.exists(path):
+            os.remove(path)
+        try:
+            save_to_netcdf(dataset, path, unlimited_dims=None, raise_errors=True)
+        finally:
+            # The memory maps have to be released before the staging files can be deleted
+            del dataset, variables, values
+        return written
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
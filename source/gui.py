@@ -1,9 +1,14 @@
 import tkinter
-from tkinter import ttk, messagebox, font
-from source import query, display_results
+from tkinter import ttk, messagebox, filedialog, font
+from source import display_results, resources
+import logging
 import queue
+import threading
+import time
 from functools import partial
 
+logger = logging.getLogger(__name__)
+
 
 # Used to ensure that the user has entered a valid float number, or is in the process of entering a valid number.
 # Because this is called after every key press, the following must also be valid:
@@ -20,17 +25,50 @@ def validate_number(value):
     return True
 
 
+# A queue that wakes the Tk main loop whenever a message is put on it, by generating a virtual event on a widget. Query
+# threads use it like any other queue, and the main loop handles each message as soon as it arrives instead of polling.
+# Tk passes events generated from other threads to the main loop safely.
+class NotifyingQueue(queue.Queue):
+    def __init__(self, widget, sequence):
+        queue.Queue.__init__(self)
+        self.widget = widget
+        self.sequence = sequence
+
+    def put(self, item, block=True, timeout=None):
+        queue.Queue.put(self, item, block, timeout)
+        try:
+            self.widget.event_generate(self.sequence, when='tail')
+        except (tkinter.TclError, RuntimeError):
+            # The window has been closed
+            pass
+
+
 # Create all the GUI elements of the application
+# start_time is the time.perf_counter() value when the program started, for reporting how long the window took to appear
 class MainApplication:
-    def __init__(self):
+    def __init__(self, start_time=None):
+        self.start_time = time.perf_counter() if start_time is None else start_time
+        # The query module pulls in numpy, pandas and xarray, which take seconds to import. It is loaded in the
+        # background once the window is up, and is None until then.
+        self.query = None
+        self.station_cache = None
+        self.profiling = None
+        self.export = None
+        # The station that the current results are for
+        self.results_station = None
+        self.selected_station = 0
+        self.query_loader = threading.Thread(target=self.load_query, daemon=True)
         self.processing_popup = None
+        self.processing_label = None
+        self.processing_stage = None
+        self.progress_bar = None
+        self.cancel_button = None
+        self.active_query = None
         self.help_popup = None
-        self.results_canvas = None
         self.tutorial_canvas = None
         self.active_canvas = None
         self.queue = None
         self.results_table = None
-        self.scrollable_frame = None
         self.results = None
         self.first_query = True
         self.months_selected = [False] * 12
@@ -43,6 +81,8 @@ class MainApplication:
         self.window.geometry('650x450')
         self.window.minsize(650, 700)
         self.window.bind('<FocusIn>', self.focus_window)
+        # Generated by the query thread whenever it puts a message on the queue
+        self.window.bind('<<QueryMessage>>', self.process_results)
 
         # Three columns
         self.column_left = tkinter.Frame(master=self.window)
@@ -64,9 +104,10 @@ class MainApplication:
 
         self.select_station_label = tkinter.Label(master=self.frame1, text='Choose a station:', width=13, anchor='w')
 
-        self.station_list = query.get_all_stations()
+        self.station_list = resources.get_all_stations()
         self.station_combobox = tkinter.ttk.Combobox(self.frame1, state='readonly', values=self.station_list)
         self.station_combobox.current(0)
+        self.station_combobox.bind('<<ComboboxSelected>>', self.prewarm_station)
 
         self.select_station_label.grid(row=0, column=0, padx=10, pady=10)
         self.station_combobox.grid(row=0, column=1, padx=5, pady=10, sticky='sew')
@@ -135,6 +176,29 @@ class MainApplication:
         self.wind_entry.insert(0, 20)
         self.wind_unit_label = tkinter.Label(master=self.frame2, text='m/s')
 
+        # Percentile checkboxes. When ticked, the value is a percentile of the station's own record instead of a
+        # measurement, e.g. temperature higher than the 95th percentile.
+        self.temperature_percentile = tkinter.BooleanVar(value=False)
+        self.temperature_percentile_checkbutton = tkinter.Checkbutton(
+            master=self.frame2, text='Percentile', variable=self.temperature_percentile,
+            command=partial(self.update_unit_label, self.temperature_unit_label, self.temperature_percentile, '°C')
+        )
+        self.precipitation_percentile = tkinter.BooleanVar(value=False)
+        self.precipitation_percentile_checkbutton = tkinter.Checkbutton(
+            master=self.frame2, text='Percentile', variable=self.precipitation_percentile,
+            command=partial(self.update_unit_label, self.precipitation_unit_label, self.precipitation_percentile, 'mm')
+        )
+        self.wind_percentile = tkinter.BooleanVar(value=False)
+        self.wind_percentile_checkbutton = tkinter.Checkbutton(
+            master=self.frame2, text='Percentile', variable=self.wind_percentile,
+            command=partial(self.update_unit_label, self.wind_unit_label, self.wind_percentile, 'm/s')
+        )
+        self.percentile_by_month = tkinter.BooleanVar(value=False)
+        self.percentile_by_month_checkbutton = tkinter.Checkbutton(
+            master=self.frame2, text='Calculate percentiles for each month separately',
+            variable=self.percentile_by_month
+        )
+
         self.temperature_label.grid(row=0, column=0, padx=10, pady=10)
         self.temperature_condition_combobox.grid(row=0, column=1, padx=5, pady=10)
         self.temperature_entry.grid(row=0, column=2, padx=10, pady=10)
@@ -147,6 +211,10 @@ class MainApplication:
         self.wind_condition_combobox.grid(row=2, column=1, padx=5, pady=10)
         self.wind_entry.grid(row=2, column=2, padx=10, pady=10)
         self.wind_unit_label.grid(row=2, column=3, pady=10)
+        self.temperature_percentile_checkbutton.grid(row=0, column=4, padx=5, pady=10)
+        self.precipitation_percentile_checkbutton.grid(row=1, column=4, padx=5, pady=10)
+        self.wind_percentile_checkbutton.grid(row=2, column=4, padx=5, pady=10)
+        self.percentile_by_month_checkbutton.grid(row=3, column=0, padx=10, columnspan=5, sticky='w')
         self.frame2.grid(row=1, column=0, padx=10, pady=10, sticky='new', columnspan=2)
 
         # Set up duration section
@@ -254,31 +322,20 @@ class MainApplication:
                                                                  offvalue=False,
                                                                  command=self.always_show_dates_checkbutton_press)
 
-        results_container = tkinter.Frame(master=self.column_right, width=50, borderwidth=3, relief='sunken')
-        results_container.grid(row=2, column=0, padx=10, pady=10, sticky='nsew')
-        results_container.rowconfigure(0, weight=1)
-        self.results_canvas = tkinter.Canvas(results_container, width=200, borderwidth=0, highlightthickness=0)
-        scrollbar = tkinter.Scrollbar(results_container, orient="vertical", command=self.results_canvas.yview)
-        scrollbar.grid(row=0, column=1, sticky='nsew')
-        self.scrollable_frame = tkinter.Frame(self.results_canvas, width=200)
-        self.scrollable_frame.columnconfigure(0, weight=1)
-        self.scrollable_frame.columnconfigure(1, weight=1)
-        self.scrollable_frame.bind("<Configure>", lambda e: self.results_canvas.configure(
-            scrollregion=self.scrollable_frame.bbox("all"))
+        # Export button. Writes the results to a file.
+        self.export_button = tkinter.Button(
+            master=self.show_dates_frame,
+            text='Export...',
+            width=10,
+            bg='#dddddd',
+            command=self.export_button_press,
+            state=tkinter.DISABLED
         )
-        canvas_frame = self.results_canvas.create_window((0, 0), window=self.scrollable_frame, anchor="nw")
-        self.results_canvas.bind('<Configure>', lambda e: self.results_canvas.itemconfig(canvas_frame,
-                                                                                         width=e.width - 4))
-        self.results_canvas.configure(yscrollcommand=scrollbar.set)
-        self.window.bind_all('<MouseWheel>', self._on_mousewheel)
-        self.results_canvas.grid(row=0, column=0, sticky='nsew')
-        self.active_canvas = self.results_canvas
 
-        # Add headers to results
-        tkinter.Label(master=self.scrollable_frame, text='Start Date', borderwidth=1, relief='ridge', anchor='w',
-                      padx=10).grid(row=0, column=0, sticky='nsew')
-        tkinter.Label(master=self.scrollable_frame, text='End Date', borderwidth=1, relief='ridge', anchor='w',
-                      padx=10).grid(row=0, column=1, sticky='nsew')
+        # Results table. Only the rows in view are drawn, so any number of results can be shown quickly.
+        self.results_table = display_results.ResultsTable(master=self.column_right, borderwidth=3, relief='sunken')
+        self.window.bind_all('<MouseWheel>', self._on_mousewheel)
+        self.active_canvas = self.results_table
 
         self.results_label.grid(row=0, column=0, padx=10, pady=10, sticky='nw')
         self.results_summary.grid()
@@ -286,13 +343,39 @@ class MainApplication:
         self.show_dates_frame.grid(row=2, column=0, pady=0)
         self.show_dates_button.grid(row=0, column=0, pady=0)
         self.always_show_dates_checkbutton.grid(row=0, column=1, padx=5, pady=0)
-        results_container.grid(row=3, column=0, padx=10, pady=10, sticky='nsew')
-
-        # List of entries of results for re-use
-        self.entries = []
+        self.export_button.grid(row=0, column=2, pady=0)
+        self.results_table.grid(row=3, column=0, padx=10, pady=10, sticky='nsew')
 
+        self.query_loader.start()
+        self.window.after_idle(self.report_startup_time)
         self.window.mainloop()
 
+    # Imports the query module. Runs in the background, see query_loader. Once loaded, starts loading the data for the
+    # selected station.
+    def load_query(self):
+        try:
+            from source import export, profiling, query, station_cache
+        except Exception:
+            logger.exception('Could not load the query module')
+            return
+        self.export = export
+        self.profiling = profiling
+        self.query = query
+        self.station_cache = station_cache
+        logger.info('Query module loaded %.2f s after start', time.perf_counter() - self.start_time)
+        station_cache.prewarm(self.selected_station)
+
+    # When a station is selected, its data starts loading in the background while the user enters the rest of the
+    # query, so the query itself does not have to wait for it. Selecting another station cancels the previous load.
+    def prewarm_station(self, event: tkinter.Event):
+        self.selected_station = self.station_combobox.current()
+        if self.station_cache is not None:
+            self.station_cache.prewarm(self.selected_station)
+
+    # Logs how long it took from starting the program until the window was ready to use
+    def report_startup_time(self):
+        logger.info('Window ready %.2f s after start', time.perf_counter() - self.start_time)
+
     # When 'Any' is selected, the entry box associated with temperature should be greyed out.
     # It should be re-enabled when an option other than 'Any' is selected.
     def update_temperature_entry(self, event: tkinter.Event):
@@ -317,6 +400,10 @@ class MainApplication:
         else:
             self.wind_entry.configure(state='normal')
 
+    # Shows the unit of a threshold, or '%ile' when the threshold is a percentile
+    def update_unit_label(self, label, as_percentile, unit):
+        label.configure(text='%ile' if as_percentile.get() else unit)
+
     # Called when an entry box is validated and the contents are found to be invalid
     # Removes the last character entered from the entry box
     def invalid_number(self, index, widget_name, action):
@@ -339,27 +426,53 @@ class MainApplication:
             'consecutive_days': int(self.duration_entry.get()),
             'temperature': {
                 'condition': self.temperature_condition_combobox.get(),
-                'as_percentile': False,
+                'as_percentile': self.temperature_percentile.get(),
+                'percentile_by_month': self.percentile_by_month.get(),
                 'value': float(self.temperature_entry.get()) if self.temperature_entry.get() != '' else None
             },
             'precipitation': {
                 'condition': self.precipitation_condition_combobox.get(),
-                'as_percentile': False,
+                'as_percentile': self.precipitation_percentile.get(),
+                'percentile_by_month': self.percentile_by_month.get(),
                 'value': float(self.precipitation_entry.get()) if self.precipitation_entry.get() != '' else None
             },
             'wind': {
                 'condition': self.wind_condition_combobox.get(),
-                'as_percentile': False,
+                'as_percentile': self.wind_percentile.get(),
+                'percentile_by_month': self.percentile_by_month.get(),
                 'value': float(self.wind_entry.get()) if self.wind_entry.get() != '' else None
             },
             'months': self.months_selected
         }
         self.open_popup()
-        self.queue = queue.Queue()
-        query.ThreadedQuery(self.queue, query_parameters).start()
-        self.process_results()
+        self.queue = NotifyingQueue(self.window, '<<QueryMessage>>')
+        self.results = []
+        self.results_station = query_parameters['station']
+        self.export_button.configure(state=tkinter.DISABLED)
+        self.active_query = None
+        self.start_query(query_parameters)
+
+    # Starts the thread that performs the query. If the query module is still loading in the background, waits for it
+    # without blocking the window.
+    def start_query(self, parameters):
+        # Cancelled before the query started
+        if self.processing_popup is None:
+            return
+        if self.query_loader.is_alive():
+            self.window.after(50, self.start_query, parameters)
+            return
+        if self.query is None:
+            messagebox.showwarning(
+                title='Error',
+                message='There was a problem loading the program. Please report this error.'
+            )
+            self.close_popup()
+            return
+        self.active_query = self.query.ThreadedQuery(self.queue, parameters, progress=True,
+                                                     timer=self.profiling.timer_from_environment())
+        self.active_query.start()
 
-    # Opens a popup that displays a progress bar while results are being fetched
+    # Opens a popup that displays the progress of the query while results are being fetched, with a button to cancel it
     def open_popup(self):
         x = self.window.winfo_x()
         y = self.window.winfo_y()
@@ -368,15 +481,37 @@ class MainApplication:
         self.processing_popup = tkinter.Toplevel(width=300, height=150)
         self.processing_popup.geometry('+%d+%d' % (x + (window_width / 2) - 100, y + (window_height / 2) - 50))
         self.processing_popup.grab_set()
-        tkinter.Label(self.processing_popup, text='Processing...').grid(row=0, column=0, padx=10, pady=10)
-        progress = ttk.Progressbar(self.processing_popup, orient=tkinter.HORIZONTAL, length=200, mode='indeterminate')
-        progress.grid(row=1, column=0, padx=10, pady=10)
-        progress.start(10)
+        self.processing_popup.protocol('WM_DELETE_WINDOW', self.cancel_query)
+        self.processing_stage = 'Processing'
+        self.processing_label = tkinter.Label(self.processing_popup, text='Processing...', width=32)
+        self.processing_label.grid(row=0, column=0, padx=10, pady=10)
+        self.progress_bar = ttk.Progressbar(self.processing_popup, orient=tkinter.HORIZONTAL, length=200,
+                                            mode='determinate', maximum=100)
+        self.progress_bar.grid(row=1, column=0, padx=10, pady=10)
+        self.cancel_button = tkinter.Button(self.processing_popup, text='Cancel', width=10, bg='#dddddd',
+                                            command=self.cancel_query)
+        self.cancel_button.grid(row=2, column=0, padx=10, pady=10)
 
     # Closes the popup
     def close_popup(self):
         self.processing_popup.grab_release()
         self.processing_popup.destroy()
+        self.processing_popup = None
+
+    # Shows what the query is doing
+    def update_processing_label(self):
+        self.processing_label['text'] = self.processing_stage + '...'
+
+    # Asks the query to stop. The popup stays open until the query thread confirms that it has stopped.
+    def cancel_query(self):
+        if self.active_query is None:
+            # The query has not started yet
+            self.close_popup()
+            return
+        self.active_query.cancel()
+        self.cancel_button.configure(state=tkinter.DISABLED)
+        self.processing_stage = 'Cancelling'
+        self.update_processing_label()
 
     # Validates input before submitting a query. Returns True if the input is valid, and returns False otherwise.
     def validate_input(self):
@@ -431,7 +566,15 @@ class MainApplication:
                     message='Temperature must be a number.'
                 )
                 return False
-            if not -273 <= temperature_value <= 100:
+            if self.temperature_percentile.get():
+                if not 0 <= temperature_value <= 100:
+                    messagebox.showwarning(
+                        title='Invalid input',
+                        message='Invalid temperature: ' + self.temperature_entry.get() +
+                                '\n\nPercentiles must be between 0 and 100.'
+                    )
+                    return False
+            elif not -273 <= temperature_value <= 100:
                 messagebox.showwarning(
                     title='Invalid input',
                     message='Invalid temperature: ' + self.temperature_entry.get() +
@@ -453,7 +596,15 @@ class MainApplication:
                     message='Precipitation must be a number.'
                 )
                 return False
-            if not 0 <= precipitation_value <= 5000:
+            if self.precipitation_percentile.get():
+                if not 0 <= precipitation_value <= 100:
+                    messagebox.showwarning(
+                        title='Invalid input',
+                        message='Invalid precipitation: ' + self.precipitation_entry.get() +
+                                '\n\nPercentiles must be between 0 and 100.'
+                    )
+                    return False
+            elif not 0 <= precipitation_value <= 5000:
                 messagebox.showwarning(
                     title='Invalid input',
                     message='Invalid precipitation: ' + self.precipitation_entry.get() +
@@ -475,7 +626,15 @@ class MainApplication:
                     message='Windspeed must be a number.'
                 )
                 return False
-            if not 0 <= wind_value <= 600:
+            if self.wind_percentile.get():
+                if not 0 <= wind_value <= 100:
+                    messagebox.showwarning(
+                        title='Invalid input',
+                        message='Invalid windspeed: ' + self.wind_entry.get() +
+                                '\n\nPercentiles must be between 0 and 100.'
+                    )
+                    return False
+            elif not 0 <= wind_value <= 600:
                 messagebox.showwarning(
                     title='Invalid input',
                     message='Invalid windspeed: ' + self.wind_entry.get() +
@@ -512,37 +671,70 @@ class MainApplication:
             return False
         return True
 
-    def process_results(self):
+    # Handles messages from the query thread. Called through the <<QueryMessage>> event each time one is put on the
+    # queue, and handles every message waiting, so later events may find the queue already empty. A single station is
+    # searched in one pass, so its results arrive all at once, and the summary and dates are then displayed.
+    def process_results(self, event=None):
         try:
-            errors, results = self.queue.get(block=False)
-            if errors is MemoryError:
-                messagebox.showwarning(
-                    title='Not enough memory',
-                    message='Insufficient memory to complete your request.'
-                )
-                self.close_popup()
+            while True:
+                errors, results = self.queue.get(block=False)
+                if errors is self.query.PROGRESS:
+                    stage, percent = results
+                    if not self.active_query.cancelled.is_set():
+                        self.processing_stage = stage
+                        self.update_processing_label()
+                    self.progress_bar['value'] = percent
+                    continue
+                if errors is self.query.CANCELLED:
+                    self.active_query = None
+                    self.display_summary(None)
+                    return
+                if errors is MemoryError:
+                    messagebox.showwarning(
+                        title='Not enough memory',
+                        message='Insufficient memory to complete your request.'
+                    )
+                    self.close_popup()
+                    return
+                elif errors:
+                    messagebox.showwarning(
+                        title='Error',
+                        message='There was a problem with your search. Please report this error.'
+                    )
+                    self.close_popup()
+                    return
+                self.results = results
+                if self.always_show_dates.get():
+                    self.display_summary(self.results)
+                    self.show_dates_button_press()
+                else:
+                    self.display_summary(self.results)
                 return
-            elif errors:
-                messagebox.showwarning(
-                    title='Error',
-                    message='There was a problem with your search. Please report this error.'
-                )
-                self.close_popup()
-                return
-            self.results = results
-            if self.always_show_dates.get():
-                self.display_summary(results)
-                self.show_dates_button_press()
-            else:
-                self.display_summary(results)
         except queue.Empty:
-            self.window.after(100, self.process_results)
+            return
 
     def show_dates_button_press(self):
-        # Open loading popup
-        self.open_popup()
-        self.queue = queue.Queue()
-        display_results.ThreadedDisplayResults(self.queue, self.results, self).start()
+        if self.results is not None:
+            self.results_table.set_results(self.results)
+        self.active_canvas = self.results_table
+
+    # Asks where to save the results, and writes them there. The format is chosen by the file extension.
+    def export_button_press(self):
+        path = filedialog.asksaveasfilename(
+            title='Export results',
+            defaultextension='.csv',
+            filetypes=[('CSV', '*.csv'), ('Parquet', '*.parquet'), ('netCDF', '*.nc')]
+        )
+        if not path:
+            return
+        try:
+            self.export.export_events(self.export.station_batches(self.results_station, [self.results]), path,
+                                      stations=resources.get_all_stations())
+        except ImportError:
+            messagebox.showwarning(title='Export', message='Exporting to Parquet needs the pyarrow package.')
+        except Exception as e:
+            logger.exception('Export failed')
+            messagebox.showwarning(title='Export', message='The results could not be exported.\n\n{}'.format(e))
 
     def always_show_dates_checkbutton_press(self):
         if self.always_show_dates.get():
@@ -567,32 +759,28 @@ class MainApplication:
         for i in range(0, 12):
             self.month_buttons[i].config(relief='raised', bg='SystemButtonFace')
 
-    # Called after results have been obtained, and displays them in the panel to the right
+    # Called once a query has finished, and displays a summary of its results in the panel to the right. results is None
+    # if the query was cancelled, which is shown in place of the summary.
     def display_summary(self, results):
-        # Update results in table
-        # Fallback in case of error during processing - clear the table
         if results is None:
-            self.results_summary['text'] = ''
-            self.close_popup()
-            return
-
-        # Refresh summary
-        new_text = 'The specified conditions have occurred {} times over 126 years (1889-2015)'.format(len(results))
-        self.results_summary['text'] = new_text
+            self.results_summary['text'] = 'The query was cancelled.'
+            self.results_table.clear()
+        else:
+            # The years covered come from the time axis of the data that was searched
+            self.results_summary['text'] = display_results.format_summary(results.statistics())
+            self.export_button.configure(state=tkinter.NORMAL)
+            if not self.always_show_dates.get():
+                self.results_table.clear()
         if self.first_query:
             self.results_summary.grid(row=1, column=0, padx=10, pady=(5, 10), sticky='ew')
             self.first_query = False
-        else:
-            for i in range(len(self.entries)):
-                self.entries[i][0].grid_forget()
-                self.entries[i][1].grid_forget()
 
-        self.active_canvas = self.results_canvas
+        self.active_canvas = self.results_table
         self.close_popup()
 
     def focus_window(self, event):
         if event.widget == self.window:
-            self.active_canvas = self.results_canvas
+            self.active_canvas = self.results_table
         elif event.widget == self.help_popup:
             self.active_canvas = self.tutorial_canvas
 
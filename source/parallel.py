@@ -0,0 +1,55 @@
+import concurrent.futures
+import multiprocessing
+import os
+from source import query
+from source.station_store import station_count
+
+"""
+Runs batch workloads on every core, rather than on a single thread limited by the GIL.
+
+Jobs are split into shards which are run in a pool of worker processes. Results are merged in shard order, so the output
+is the same, in the same order, whatever the number of workers.
+"""
+
+# Number of stations in each shard sent to a worker process
+SHARD_SIZE = 64
+
+
+# Returns the number of worker processes to use if none is specified: one per core
+def default_workers():
+    return os.cpu_count() or 1
+
+
+# Runs function over each set of arguments in a pool of worker processes. Workers are always spawned rather than forked,
+# as forking a process that has the netCDF/HDF5 libraries open can deadlock.
+# Returns the results in the same order as the arguments
+def _map(function, arguments, workers):
+    workers = default_workers() if workers is None else workers
+    if workers <= 1 or len(arguments) <= 1:
+        return [function(*args) for args in arguments]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(arguments)),
+                                                mp_context=multiprocessing.get_context('spawn')) as executor:
+        return list(executor.map(function, *zip(*arguments)))
+
+
+# Evaluates one set of parameters across every station, the same as query.batch_query, with stations split into shards
+# of `shard_size` that are searched in parallel. Within each shard, stations are loaded and searched `chunk_size` at a
+# time.
+# Returns results in the structure described in query.batch_query, with stations in order
+def parallel_batch_query(parameters, counts_only=False, workers=None, shard_size=SHARD_SIZE,
+                         chunk_size=query.BATCH_CHUNK_SIZE):
+    n_stations = station_count()
+    shards = [(parameters, counts_only, chunk_size, start, min(start + shard_size, n_stations))
+              for start in range(0, n_stations, shard_size)]
+    results = {}
+    for shard_results in _map(query.batch_query, shards, workers):
+        results.update(shard_results)
+    return results
+
+
+# Runs a single-station query for each set of parameters, in parallel. Useful for sweeping the parameters of a query, or
+# running the same query at a list of stations.
+# Returns a list with the results of each query, in the structure described in query.ThreadedQuery.run, in the same
+# order as parameter_list
+def parallel_queries(parameter_list, workers=None):
+    return _map(query.run_query, [(parameters,) for parameters in parameter_list], workers)
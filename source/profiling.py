@@ -0,0 +1,144 @@
+import collections
+import contextlib
+import cProfile
+import datetime
+import io
+import logging
+import os
+import pstats
+import time
+import tracemalloc
+from utils.logger_writer import LoggerWriter
+
+"""
+Shows where the time goes in a query. A StageTimer is passed through the query pipeline, which marks each of its stages
+(loading data, working out thresholds, each condition, combining them and finding the events). As each stage finishes,
+its wall time, and optionally the change in memory allocated, is passed to a hook, which logs it by default. Once the
+query is done, the totals for each stage are logged.
+
+A timer can also profile the whole query with cProfile, writing the statistics to a file that can be read with pstats,
+and logging the functions that took the most time.
+
+The GUI does not time queries unless asked to by environment variables: HEEAT_TIMINGS=1 logs stage timings, and
+HEEAT_PROFILE=<directory> also writes a profile of every query to that directory.
+"""
+
+# Environment variables that turn on timing for queries started from the GUI
+TIMINGS_VARIABLE = 'HEEAT_TIMINGS'
+PROFILE_DIRECTORY_VARIABLE = 'HEEAT_PROFILE'
+
+# Number of functions logged from a profile
+PROFILE_LINES = 25
+
+logger = logging.getLogger(__name__)
+
+
+# The default hook. Logs each stage as it finishes, at debug level, as a batch query repeats its stages for every chunk
+# of stations.
+#   memory: change in memory allocated during the stage in bytes, or None if memory is not traced
+def log_stage(stage, seconds, memory):
+    if memory is None:
+        logger.debug('%s: %.1f ms', stage, seconds * 1000)
+    else:
+        logger.debug('%s: %.1f ms, %+.1f MB', stage, seconds * 1000, memory / 1024 / 1024)
+
+
+# Times the stages of a query. Use as a context manager around the whole query, and call stage() for each step.
+#   hook: function called with (stage, seconds, memory) as each stage finishes, as described in log_stage, or None
+#   trace_memory: if True, memory allocations are traced with tracemalloc while the timer is in use, so each stage
+#                 reports how much memory it allocated. Tracing counts allocations from every thread, and slows down
+#                 code that allocates a lot, so timings are higher while it is on.
+#   profile_path: if given, the query is also profiled with cProfile, and the statistics are written to this file
+class StageTimer:
+    def __init__(self, hook=log_stage, trace_memory=False, profile_path=None):
+        self.hook = hook
+        self.trace_memory = trace_memory
+        self.profile_path = profile_path
+        self.stages = []
+        self.profiler = None
+        self.started_tracing = False
+        self.start_time = None
+
+    def __enter__(self):
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+        if self.profile_path is not None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        total = time.perf_counter() - self.start_time
+        if self.profiler is not None:
+            self.profiler.disable()
+            self._write_profile()
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+        self.log_totals(total)
+
+    # Times the code run inside the with block as one stage of the query
+    @contextlib.contextmanager
+    def stage(self, name):
+        tracing = tracemalloc.is_tracing()
+        memory_before = tracemalloc.get_traced_memory()[0] if tracing else 0
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            memory = tracemalloc.get_traced_memory()[0] - memory_before if tracing else None
+            self.stages.append((name, seconds, memory))
+            if self.hook is not None:
+                self.hook(name, seconds, memory)
+
+    # Returns {} of stage to (total seconds, total change in memory in bytes or None), in the order the stages first ran
+    def totals(self):
+        totals = collections.OrderedDict()
+        for name, seconds, memory in self.stages:
+            total_seconds, total_memory = totals.get(name, (0, None if memory is None else 0))
+            totals[name] = (total_seconds + seconds, None if memory is None else total_memory + memory)
+        return totals
+
+    # Logs the total time spent in each stage, and in the query as a whole
+    def log_totals(self, total):
+        for name, (seconds, memory) in self.totals().items():
+            if memory is None:
+                logger.info('%-24s %8.1f ms', name, seconds * 1000)
+            else:
+                logger.info('%-24s %8.1f ms %+8.1f MB', name, seconds * 1000, memory / 1024 / 1024)
+        logger.info('%-24s %8.1f ms', 'Query', total * 1000)
+
+    def _write_profile(self):
+        self.profiler.dump_stats(self.profile_path)
+        logger.info('Profile written to ' + self.profile_path)
+        # pstats writes a line in many pieces, so the report is collected first and logged as one message
+        report = io.StringIO()
+        pstats.Stats(self.profiler, stream=report).sort_stats('cumulative').print_stats(PROFILE_LINES)
+        LoggerWriter(logger, logging.INFO).write(report.getvalue())
+
+
+# Times one stage with timer, or does nothing if timer is None
+def stage(timer, name):
+    return contextlib.nullcontext() if timer is None else timer.stage(name)
+
+
+# Returns a context manager that runs timer around the whole query, or does nothing if timer is None
+def timing(timer):
+    return contextlib.nullcontext() if timer is None else timer
+
+
+# Returns a StageTimer set up by the environment variables described above, or None if neither is set. Each call
+# profiles to a new file.
+def timer_from_environment():
+    profile_directory = os.environ.get(PROFILE_DIRECTORY_VARIABLE)
+    if not os.environ.get(TIMINGS_VARIABLE) and not profile_directory:
+        return None
+    profile_path = None
+    if profile_directory:
+        os.makedirs(profile_directory, exist_ok=True)
+        name = 'query-{}.prof'.format(datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f'))
+        profile_path = os.path.join(profile_directory, name)
+    return StageTimer(trace_memory=True, profile_path=profile_path)
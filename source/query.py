@@ -1,170 +1,151 @@
-import xarray
 import numpy
-import pandas
-import sys
-import os
 import threading
+from source import climatology, events, profiling, result_cache
+from source.station_cache import load_station
+from source.station_store import iter_station_chunks, station_count
 
+# Number of stations loaded and searched together by a batch query
+BATCH_CHUNK_SIZE = 32
 
+# How far through a single station query (in percent) each stage starts, for progress reporting. Loading the data
+# reports its progress variable by variable up to SEARCH_PROGRESS, and the search condition by condition up to
+# EVENTS_PROGRESS, where events are found.
+SEARCH_PROGRESS = 40
+EVENTS_PROGRESS = 90
+
+# Messages put on the queue by the query threads are (errors, results) tuples. When streaming, results are sent in
+# batches as (PARTIAL, batch) as soon as they are ready, followed by (None, COMPLETE) once the search has finished. A
+# single station is searched in one vectorized pass, so its results are sent as one batch, which is empty if no events
+# were found.
+# Otherwise all results are sent at once as (None, results). Errors are sent as (MemoryError, None) or
+# (Exception, None). If progress is requested, (PROGRESS, (stage, percent)) is sent as the query moves along, where
+# stage describes what the query is doing and percent (0-100) is how much of the whole query is done. A query that is
+# cancelled stops with (CANCELLED, None).
+PARTIAL = 'partial'
+COMPLETE = 'complete'
+PROGRESS = 'progress'
+CANCELLED = 'cancelled'
+
+
+# Raised inside a query when it has been cancelled
+class Cancelled(Exception):
+    pass
+
+
+# Raises Cancelled if the cancellation event has been set. Queries call this between steps, so a cancelled query stops
+# (and releases the data it holds) within one step.
+def check_cancelled(cancelled):
+    if cancelled is not None and cancelled.is_set():
+        raise Cancelled()
+
+
+# Returns a function that reports progress on the queue, as described above
+def _queue_progress(queue):
+    return lambda stage, percent: queue.put((PROGRESS, (stage, percent)))
+
+
+def _no_progress(stage, percent):
+    pass
+
+
+# Call cancel() to stop the query early. If progress is True, progress messages are sent on the queue. To time each
+# stage of the query (and optionally profile it), give a profiling.StageTimer as timer.
 class ThreadedQuery(threading.Thread):
-    def __init__(self, queue, parameters):
+    def __init__(self, queue, parameters, stream=False, progress=False, timer=None):
         threading.Thread.__init__(self)
         self.queue = queue
         self.parameters = parameters
+        self.stream = stream
+        self.progress = _queue_progress(queue) if progress else None
+        self.timer = timer
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
 
     # What this program actually does. Takes parameters specified by the user and searches data to find instances that
     # fit those parameters. Expects parameters in the following structure:
     # parameters: {}
     #   temperature: {}
     #       condition: {} (Must be 'Any', 'Higher Than', or 'Lower Than')
+    #       as_percentile: bool (If True, value is a percentile (0-100) of the station's own record)
+    #       percentile_by_month: bool (Optional. If True, the percentile is of each calendar month separately)
     #       value: float
     #   precipitation: {}
     #       condition: {} (Must be 'Any', 'Higher Than', or 'Lower Than')
+    #       as_percentile: bool
+    #       percentile_by_month: bool
     #       value: float
     #   wind: {}
     #       condition: {} (Must be 'Any', 'Higher Than', or 'Lower Than')
+    #       as_percentile: bool
+    #       percentile_by_month: bool
     #       value: float
     #   months: [] (True or False)
     # station: int
     # consecutive_days: int
     #
     # Should return results in the following structure:
-    # results: []
-    #   (start_date: Pandas Timeframe, end_date: Pandas Timeframe) <- tuple
+    # results: events.EventList, which behaves as a list of
+    #   (start_date: Pandas Timestamp, end_date: Pandas Timestamp) <- tuple
+    #
+    # If streaming, the results are sent as one batch, as described above.
+    def run(self):
+        try:
+            with profiling.timing(self.timer):
+                if self.stream:
+                    for batch in iter_query(self.parameters, self.progress, self.cancelled, self.timer):
+                        self.queue.put((PARTIAL, batch))
+                    results = COMPLETE
+                else:
+                    results = run_query(self.parameters, self.progress, self.cancelled, self.timer)
+        except Cancelled:
+            self.queue.put((CANCELLED, None))
+            return
+        except MemoryError:
+            self.queue.put((MemoryError, None))
+            return
+        except:
+            self.queue.put((Exception, None))
+            return
+        self.queue.put((None, results))
+
+
+# Runs the same search as ThreadedQuery across every station, rather than the one station in the parameters. The
+# 'station' parameter is ignored.
+# If streaming, the results for each chunk of stations are sent as soon as that chunk has been searched.
+# Call cancel() to stop the query early. If progress is True, progress messages are sent on the queue. Takes timer as
+# described in ThreadedQuery.
+class ThreadedBatchQuery(threading.Thread):
+    def __init__(self, queue, parameters, counts_only=False, chunk_size=BATCH_CHUNK_SIZE, stream=False,
+                 progress=False, timer=None):
+        threading.Thread.__init__(self)
+        self.queue = queue
+        self.parameters = parameters
+        self.counts_only = counts_only
+        self.chunk_size = chunk_size
+        self.stream = stream
+        self.progress = _queue_progress(queue) if progress else None
+        self.timer = timer
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
     def run(self):
         try:
-            # Load data
-            data = xarray.open_mfdataset([
-                resource_path('data/minimum_temperature.nc'),
-                resource_path('data/maximum_temperature.nc'),
-                resource_path('data/precipitation.nc'),
-                resource_path('data/windspeed.nc')
-            ], join='override')
-
-            # Narrow down data to parameters
-            # Station
-            data = data.where(data.region == self.parameters['station'], drop=True)
-
-            # Months
-            filter_months = not all(self.parameters['months'])
-            month_mask = None
-            if filter_months:
-                months_in_filter = []
-                for i, month in enumerate(self.parameters['months']):
-                    if month:
-                        months_in_filter.append(i+1)
-                data.load()
-                month_mask = ~numpy.in1d(data['time.month'], months_in_filter)
-                data['precipitation'][:, month_mask] = numpy.nan
-                data['windspeed'][:, month_mask] = numpy.nan
-                data['minimum_temperature'][:, month_mask] = numpy.nan
-                data['maximum_temperature'][:, month_mask] = numpy.nan
-
-            # Temperature
-            arrays_to_combine = []
-            if self.parameters['temperature']['condition'] == 'Lower Than':
-                arrays_to_combine.append(
-                    data.minimum_temperature.where(data.minimum_temperature < self.parameters['temperature']['value'])
-                )
-            elif self.parameters['temperature']['condition'] == 'Higher Than':
-                arrays_to_combine.append(data.maximum_temperature.where(
-                    data.maximum_temperature > self.parameters['temperature']['value']
-                ))
-
-            # Precipitation
-            # Is accumulation instead of every day. Calculate rolling accumulation for the given duration
-            data['precipitation'] = data.precipitation.rolling(
-                time=self.parameters['consecutive_days'], min_periods=1
-            ).sum()
-            precipitation_bool = None
-            if self.parameters['precipitation']['condition'] == 'Lower Than':
-                precipitation_bool = ~numpy.isnan(
-                    data.precipitation.where(data.precipitation < self.parameters['precipitation']['value'])[0].values
-                )
-            elif self.parameters['precipitation']['condition'] == 'Higher Than':
-                precipitation_bool = ~numpy.isnan(
-                    data.precipitation.where(data.precipitation > self.parameters['precipitation']['value'])[0].values
-                )
-
-            # Wind
-            if self.parameters['wind']['condition'] == 'Lower Than':
-                arrays_to_combine.append(data.windspeed.where(data.windspeed < self.parameters['wind']['value']))
-            elif self.parameters['wind']['condition'] == 'Higher Than':
-                arrays_to_combine.append(data.windspeed.where(data.windspeed > self.parameters['wind']['value']))
-
-            # Combine results
-            combined_data = None
-            if len(arrays_to_combine) > 0:
-                combined_data = ~numpy.isnan(arrays_to_combine[0].values[0])
-                for i in range(1, len(arrays_to_combine)):
-                    combined_data = numpy.logical_and(combined_data, ~numpy.isnan(arrays_to_combine[i].values[0]))
-
-            # Get the rest of the data required and close files
-            time_dimension = data.time.size
-            data.close()
-
-            # Count consecutive days and record instances
-            results = []
-            i_consecutive = 0
-            query_precipitation = False if self.parameters['precipitation']['condition'] == 'Any' else True
-            query_wind = False if self.parameters['wind']['condition'] == 'Any' else True
-            query_temperature = False if self.parameters['temperature']['condition'] == 'Any' else True
-
-            # These could be combined to reduce repeated code, but separating them eliminates thousands of unnecessary
-            # checks, speeding things up. Readability is compromised in favour of performance.
-            # If only temperature and wind
-            if not query_precipitation:
-                for i_date in range(0, data.time.size):
-                    if combined_data[i_date]:
-                        i_consecutive += 1
-                    elif i_consecutive >= self.parameters['consecutive_days']:
-                        start_date = data.time.values[i_date - i_consecutive]
-                        start_date = pandas.to_datetime(start_date)
-                        end_date = data.time.values[i_date - 1]
-                        end_date = pandas.to_datetime(end_date)
-                        results.append((start_date, end_date))
-                        i_consecutive = 0
-                    else:
-                        i_consecutive = 0
-                if i_consecutive >= self.parameters['consecutive_days']:
-                    start_date = data.time.values[data.time.size - i_consecutive]
-                    start_date = pandas.to_datetime(start_date)
-                    end_date = data.time.values[data.time.size - 1]
-                    end_date = pandas.to_datetime(end_date)
-                    results.append((start_date, end_date))
-            # If only precipitation
-            elif not query_wind and not query_temperature:
-                i_date = 0
-                while i_date < data.time.size:
-                    if precipitation_bool[i_date]:
-                        start_i = i_date - self.parameters['consecutive_days'] + 1
-                        if start_i < 0:
-                            start_i = 0
-                        if not filter_months or not(month_mask[start_i] or month_mask[i_date]):
-                            start_date = pandas.to_datetime(data.time.values[start_i])
-                            end_date = pandas.to_datetime(data.time.values[i_date])
-                            results.append((start_date, end_date))
-                            i_date = i_date + self.parameters['consecutive_days']
-                    i_date += 1
-            # If combination of precipitation and other conditions
-            elif query_precipitation and (query_wind or query_temperature):
-                for i_date in range(0, time_dimension):
-                    if combined_data[i_date]:
-                        i_consecutive += 1
-                        if i_consecutive >= self.parameters['consecutive_days']:
-                            # Check precipitation requirement - if not met, move window along one space
-                            if not precipitation_bool[i_date]:
-                                i_consecutive -= 1
-                                continue
-                            start_date = pandas.to_datetime(data.time.values[i_date - i_consecutive] + 1)
-                            end_date = pandas.to_datetime(data.time.values[i_date])
-                            results.append((start_date, end_date))
-                            i_consecutive = 0
-                    else:
-                        i_consecutive = 0
-            else:
-                self.queue.put((Exception, None))
-                return
+            with profiling.timing(self.timer):
+                if self.stream:
+                    for batch in iter_batch_query(self.parameters, self.counts_only, self.chunk_size,
+                                                  progress=self.progress, cancelled=self.cancelled, timer=self.timer):
+                        self.queue.put((PARTIAL, batch))
+                    results = COMPLETE
+                else:
+                    results = batch_query(self.parameters, self.counts_only, self.chunk_size, progress=self.progress,
+                                          cancelled=self.cancelled, timer=self.timer)
+        except Cancelled:
+            self.queue.put((CANCELLED, None))
+            return
         except MemoryError:
             self.queue.put((MemoryError, None))
             return
@@ -174,20 +155,237 @@ class ThreadedQuery(threading.Thread):
         self.queue.put((None, results))
 
 
-# For populating the station dropdown in the GUI
-def get_all_stations():
-    with open(resource_path('data/locations.txt'), 'r') as file:
-        stations = file.read().split('\n')
-    return stations
+# Turns the parameters into boolean conditions over a Dataset holding any number of stations. Expects parameters in the
+# structure described in ThreadedQuery.run. Each step is timed as a stage if a profiling.StageTimer is given, and
+# reported to the optional function progress as (stage, fraction) as it starts, where fraction (0-1) is how many of the
+# steps are done.
+# Returns (condition, precipitation, month_mask):
+#   condition: (region, time) bool array of days meeting the temperature and wind conditions, or None if neither is set
+#   precipitation: (region, time) bool array of days where precipitation accumulated over consecutive_days meets the
+#                  precipitation condition, or None if it is not set
+#   month_mask: (time,) bool array of days outside of the selected months, or None if all months are selected
+def build_conditions(data, parameters, timer=None, progress=None):
+    selected = [variable for variable in ['temperature', 'precipitation', 'wind']
+                if parameters[variable]['condition'] != 'Any']
+    # Thresholds, the month mask, each condition, and combining the temperature and wind conditions
+    combines = any(variable != 'precipitation' for variable in selected)
+    steps = 1 + (not all(parameters['months'])) + len(selected) + combines
+    done = 0
+
+    def report(stage):
+        nonlocal done
+        if progress is not None:
+            progress(stage, done / steps)
+        done += 1
+
+    report('Working out thresholds')
+    with profiling.stage(timer, 'Thresholds'):
+        thresholds = resolve_thresholds(data, parameters)
+
+    # Months
+    # Days outside of the selected months never meet a condition. The data itself is left untouched.
+    month_mask = None
+    if not all(parameters['months']):
+        report('Filtering months')
+        with profiling.stage(timer, 'Month mask'):
+            months_in_filter = [i + 1 for i, month in enumerate(parameters['months']) if month]
+            month_mask = ~numpy.isin(data['time.month'].values, months_in_filter)
+
+    # Temperature
+    # Comparisons with missing (NaN) days are always False
+    conditions = []
+    if parameters['temperature']['condition'] != 'Any':
+        report('Checking temperature')
+        with profiling.stage(timer, 'Temperature'):
+            if parameters['temperature']['condition'] == 'Lower Than':
+                conditions.append(_values(data, 'minimum_temperature') < thresholds['temperature'])
+            elif parameters['temperature']['condition'] == 'Higher Than':
+                conditions.append(_values(data, 'maximum_temperature') > thresholds['temperature'])
+
+    # Precipitation
+    # Is accumulation instead of every day. Calculate rolling accumulation for the given duration, leaving out days
+    # outside of the selected months. Days where the accumulation is missing never meet the condition.
+    precipitation_bool = None
+    if parameters['precipitation']['condition'] != 'Any':
+        report('Accumulating precipitation')
+        with profiling.stage(timer, 'Precipitation'):
+            precipitation = events.rolling_sum(_values(data, 'precipitation'), parameters['consecutive_days'],
+                                               month_mask)
+            if parameters['precipitation']['condition'] == 'Lower Than':
+                precipitation_bool = precipitation < thresholds['precipitation']
+            elif parameters['precipitation']['condition'] == 'Higher Than':
+                precipitation_bool = precipitation > thresholds['precipitation']
+
+    # Wind
+    if parameters['wind']['condition'] != 'Any':
+        report('Checking windspeed')
+        with profiling.stage(timer, 'Wind'):
+            if parameters['wind']['condition'] == 'Lower Than':
+                conditions.append(_values(data, 'windspeed') < thresholds['wind'])
+            elif parameters['wind']['condition'] == 'Higher Than':
+                conditions.append(_values(data, 'windspeed') > thresholds['wind'])
+
+    # Combine results
+    combined_data = None
+    if len(conditions) > 0:
+        report('Combining conditions')
+        with profiling.stage(timer, 'Combining'):
+            combined_data = numpy.logical_and.reduce(conditions)
+            if month_mask is not None:
+                combined_data &= ~month_mask
+    return combined_data, precipitation_bool, month_mask
+
+
+# Returns a data variable as a (region, time) NumPy array, without copying it where possible
+def _values(data, variable):
+    return data[variable].transpose('region', 'time').values
+
+
+# Finds the threshold for each variable with a condition. Thresholds given as percentiles are turned into values at each
+# station: from the climatology table for daily values at whole percentiles, from the daily values themselves at other
+# percentiles, or, for precipitation accumulated over more than one day, from the accumulation itself.
+# Returns {} of variable to a float, or an array that broadcasts against (region, time): (region, 1), or (region, time)
+# if the percentile is by month
+def resolve_thresholds(data, parameters):
+    names = {
+        'temperature': 'minimum_temperature' if parameters['temperature']['condition'] == 'Lower Than'
+        else 'maximum_temperature',
+        'precipitation': 'precipitation',
+        'wind': 'windspeed'
+    }
+    thresholds = {}
+    for variable, name in names.items():
+        settings = parameters[variable]
+        if settings['condition'] == 'Any':
+            continue
+        if not settings.get('as_percentile', False):
+            thresholds[variable] = settings['value']
+            continue
+        by_month = settings.get('percentile_by_month', False)
+        months = data['time.month'].values
+        if variable == 'precipitation' and parameters['consecutive_days'] > 1:
+            accumulation = events.rolling_sum(_values(data, 'precipitation'), parameters['consecutive_days'])
+            values = climatology.percentile_of(accumulation, settings['value'], months, by_month)
+        else:
+            values = climatology.station_percentiles(data, name, settings['value'], by_month)
+        thresholds[variable] = values[:, months - 1] if by_month else values[:, numpy.newaxis]
+    return thresholds
+
+
+# Searches the data for a single station, producing its results as batches in the same way as iter_batch_query, so
+# both can be consumed alike (for example by export.export_events). The station is searched in one vectorized pass, so
+# there is nothing to send before the search ends, and the results are produced as a single batch, which is empty if no
+# events are found. Queries that have been run before are answered from the result cache.
+# Expects parameters in the structure described in ThreadedQuery.run.
+#   progress: optional function called with (stage, percent) as the query moves along
+#   cancelled: optional threading.Event. Once set, the query raises Cancelled at its next step.
+#   timer: optional profiling.StageTimer that times each stage of the query
+# Yields the events.EventList of results
+def iter_query(parameters, progress=None, cancelled=None, timer=None):
+    yield run_query(parameters, progress, cancelled, timer)
+
+
+# Returns the events.EventList for a query from the result cache, or searches for it and caches it
+def _cached_query_events(parameters, progress, cancelled, timer):
+    with profiling.stage(timer, 'Result cache'):
+        results = result_cache.cache.get(parameters)
+    if results is None:
+        results = find_query_events(parameters, progress, cancelled, timer)
+        with profiling.stage(timer, 'Result cache'):
+            result_cache.cache.put(parameters, results)
+    return results
+
+
+# Searches the data for a single station. Expects parameters in the structure described in ThreadedQuery.run, and
+# progress, cancelled and timer as described in iter_query.
+# Returns an events.EventList
+def find_query_events(parameters, progress=None, cancelled=None, timer=None):
+    progress = _no_progress if progress is None else progress
+    # Load only the data for the selected station
+    progress('Loading data', 0)
+    with profiling.stage(timer, 'Loading data'):
+        data = load_station(parameters['station'], cancelled,
+                            lambda fraction: progress('Loading data', int(SEARCH_PROGRESS * fraction)))
+    check_cancelled(cancelled)
+    condition, precipitation, month_mask = build_conditions(
+        data, parameters, timer,
+        lambda stage, fraction: progress(stage, SEARCH_PROGRESS + int((EVENTS_PROGRESS - SEARCH_PROGRESS) * fraction)))
+    time = data.time.values
+    data.close()
+    check_cancelled(cancelled)
+
+    progress('Finding events', EVENTS_PROGRESS)
+    with profiling.stage(timer, 'Finding events'):
+        starts, ends = events.find_events(None if condition is None else condition[0],
+                                          None if precipitation is None else precipitation[0],
+                                          parameters['consecutive_days'], month_mask)
+    return events.EventList(time, starts, ends)
+
+
+# Searches the data for a single station. Expects parameters, and returns results, in the structure described in
+# ThreadedQuery.run. Takes progress, cancelled and timer as described in iter_query.
+def run_query(parameters, progress=None, cancelled=None, timer=None):
+    progress = _no_progress if progress is None else progress
+    results = _cached_query_events(parameters, progress, cancelled, timer)
+    progress('Complete', 100)
+    return results
+
+
+# Evaluates one set of parameters across every station. Stations are loaded and searched `chunk_size` at a time, so
+# memory stays bounded while each chunk is processed as a single (region, time) array operation. The 'station'
+# parameter is ignored. To search only some of the stations, give a range of positions along the region dimension with
+# start and stop. Takes progress, cancelled and timer as described in iter_query, with progress measured in stations
+# searched, and each stage timed once for every chunk.
+# Yields the results for each chunk of stations, in the structure described in batch_query
+def iter_batch_query(parameters, counts_only=False, chunk_size=BATCH_CHUNK_SIZE, start=0, stop=None, progress=None,
+                     cancelled=None, timer=None):
+    total = 1
+    if progress is None:
+        progress = _no_progress
+    else:
+        count = station_count()
+        total = max((count if stop is None else min(stop, count)) - start, 1)
+    searched = 0
+    progress('Searching stations', 0)
+    chunks = iter_station_chunks(chunk_size, start, stop)
+    while True:
+        # Chunks are read as they are taken from the iterator
+        with profiling.stage(timer, 'Loading data'):
+            data = next(chunks, None)
+        if data is None:
+            break
+        check_cancelled(cancelled)
+        condition, precipitation, month_mask = build_conditions(data, parameters, timer)
+        with profiling.stage(timer, 'Finding events'):
+            stations, starts, ends = events.find_station_events(condition, precipitation,
+                                                                parameters['consecutive_days'], month_mask)
+        regions = data.region.values
+        if counts_only:
+            counts = numpy.bincount(stations, minlength=regions.size)
+            results = dict(zip(regions.tolist(), counts.tolist()))
+        else:
+            # Every station in the chunk shares one time axis and one pair of index arrays
+            found = events.EventList(data.time.values, starts, ends)
+            boundaries = numpy.searchsorted(stations, numpy.arange(regions.size + 1))
+            results = {station: found[boundaries[i]:boundaries[i + 1]] for i, station in enumerate(regions.tolist())}
+        data.close()
+        searched += regions.size
+        progress('Searching stations', 100 * searched // total)
+        yield results
+
 
+# Evaluates one set of parameters across every station, as described in iter_batch_query.
+#
+# Returns results in the following structure:
+# results: {}
+#   station (int): events.EventList of (start_date: Pandas Timestamp, end_date: Pandas Timestamp) <- tuple
+# or, if counts_only is True:
+# results: {}
+#   station (int): number of events (int)
+def batch_query(parameters, counts_only=False, chunk_size=BATCH_CHUNK_SIZE, start=0, stop=None, progress=None,
+                cancelled=None, timer=None):
+    results = {}
+    for batch in iter_batch_query(parameters, counts_only, chunk_size, start, stop, progress, cancelled, timer):
+        results.update(batch)
+    return results
 
-# Helps the program find where files are when packaged into an application by PyInstaller
-# Works for dev environment as well
-# Returns the absolute path
-def resource_path(relative_path):
-    try:
-        # PyInstaller creates a temp folder and stores path in _MEIPASS
-        base_path = sys._MEIPASS
-    except Exception:
-        base_path = os.path.abspath(".")
-    return os.path.join(base_path, relative_path)
\ No newline at end of file
@@ -0,0 +1,140 @@
+import argparse
+import logging
+import os
+import time
+import numpy
+import xarray
+from source import data, resources
+from utils import save_to_netcdf
+
+"""
+Rewrites the netCDF files in data/ with a chosen storage layout (chunk shape, compression level and shuffle filter), and
+measures how quickly single stations can be read back from the new files.
+
+Queries read one station at a time. If each station's whole record is stored as one chunk (region=1, with time stored
+whole), reading a station is a single contiguous read and decompression, instead of pieces of many chunks that each
+hold parts of other stations.
+
+The new files are written to a separate directory. Check the benchmark, then copy them into data/. If the variables are
+merged, the single file (all_variables.nc) is read in place of the four separate files.
+"""
+
+# Default chunk sizes. Dimensions that are not given are stored whole.
+DEFAULT_CHUNKS = {'region': 1}
+
+# Default zlib compression level, from 0 (uncompressed) to 9
+DEFAULT_COMPLEVEL = 4
+
+# Number of randomly chosen stations read by the benchmark
+BENCHMARK_SAMPLES = 20
+
+logger = logging.getLogger(__name__)
+
+
+# Builds the netCDF encoding for every variable in a dataset.
+#   chunks: {} of dimension to chunk size. Dimensions not given are stored whole.
+#   complevel: zlib compression level, 0 (uncompressed) to 9
+#   shuffle: whether to apply the shuffle filter before compressing, which usually helps with floating point data
+def build_encoding(dataset, chunks, complevel, shuffle):
+    encoding = {}
+    for variable in dataset.data_vars:
+        sizes = dataset[variable].sizes
+        encoding[variable] = {
+            'zlib': complevel > 0,
+            'complevel': complevel,
+            'shuffle': shuffle and complevel > 0,
+            'chunksizes': tuple(min(chunks.get(dim, sizes[dim]), sizes[dim]) for dim in dataset[variable].dims)
+        }
+    return encoding
+
+
+# Writes the data with a new layout to output_directory, keeping the file names used in data/. If merge is True, all
+# variables are written to a single file instead.
+# Returns the paths of the files written
+def repack(output_directory, chunks=None, complevel=DEFAULT_COMPLEVEL, shuffle=True, merge=False):
+    chunks = DEFAULT_CHUNKS if chunks is None else chunks
+    if os.path.abspath(output_directory) == resources.data_directory():
+        raise ValueError('Write the repacked files to a different directory, then copy them into data/')
+    sources = data.data_files()
+    if merge:
+        groups = [(data.MERGED_FILE, sources)]
+    else:
+        groups = [(os.path.basename(path), [path]) for path in sources]
+    written = []
+    for name, paths in groups:
+        path = os.path.join(output_directory, name)
+        if os.path.exists(path):
+            os.remove(path)
+        with xarray.open_mfdataset(paths, join='override') as dataset:
+            # The data never grows, so time does not need to be an unlimited dimension
+            save_to_netcdf(dataset, path, build_encoding(dataset, chunks, complevel, shuffle), logging.INFO,
+                           unlimited_dims=None, raise_errors=True)
+        written.append(path)
+    return written
+
+
+# Times reading single stations from a set of netCDF files, the same way queries read them.
+# Returns {} with the total size of the files in bytes, and the time taken to open the files and to read one station
+# (mean and slowest), in seconds
+def benchmark_reads(paths, samples=BENCHMARK_SAMPLES, seed=0):
+    start = time.perf_counter()
+    with xarray.open_mfdataset(paths, join='override') as dataset:
+        open_time = time.perf_counter() - start
+        positions = numpy.random.default_rng(seed).integers(0, dataset.region.size, samples)
+        read_times = []
+        for position in positions.tolist():
+            start = time.perf_counter()
+            dataset.isel(region=[position]).load()
+            read_times.append(time.perf_counter() - start)
+    return {
+        'size': sum(os.path.getsize(path) for path in paths),
+        'open': open_time,
+        'read_mean': float(numpy.mean(read_times)),
+        'read_max': float(numpy.max(read_times))
+    }
+
+
+def _print_benchmark(name, results):
+    print('{:<12} {:>10.1f} {:>10.1f} {:>16.2f} {:>16.2f}'.format(
+        name, results['size'] / 1024 / 1024, results['open'] * 1000, results['read_mean'] * 1000,
+        results['read_max'] * 1000))
+
+
+# Parses chunk sizes given on the command line as DIMENSION=SIZE, where SIZE is a number or 'full'
+def parse_chunks(values):
+    chunks = {}
+    for value in values:
+        dimension, _, size = value.partition('=')
+        if dimension not in ('region', 'time') or size == '':
+            raise ValueError('Chunk sizes must be given as region=SIZE or time=SIZE: ' + value)
+        if size != 'full':
+            chunks[dimension] = int(size)
+            if chunks[dimension] < 1:
+                raise ValueError('Chunk sizes must be at least 1: ' + value)
+    return chunks
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s",
+                        datefmt="%Y-%m-%d  %H:%M:%S")
+    parser = argparse.ArgumentParser(description='Rewrite the netCDF files in data/ with a new chunking and '
+                                                 'compression layout, and benchmark single-station reads.')
+    parser.add_argument('--output', required=True, help='directory to write the repacked files to')
+    parser.add_argument('--chunks', nargs='+', metavar='DIMENSION=SIZE', default=['region=1', 'time=full'],
+                        help='chunk size for each dimension, or full (default: region=1 time=full)')
+    parser.add_argument('--complevel', type=int, choices=range(10), default=DEFAULT_COMPLEVEL,
+                        help='zlib compression level, 0 for none (default: {})'.format(DEFAULT_COMPLEVEL))
+    parser.add_argument('--no-shuffle', action='store_true', help='do not apply the shuffle filter')
+    parser.add_argument('--merge', action='store_true', help='write all four variables to a single file')
+    parser.add_argument('--samples', type=int, default=BENCHMARK_SAMPLES,
+                        help='number of stations to read in the benchmark (default: {})'.format(BENCHMARK_SAMPLES))
+    args = parser.parse_args()
+    try:
+        chunks = parse_chunks(args.chunks)
+    except ValueError as e:
+        parser.error(str(e))
+    files = repack(args.output, chunks, args.complevel, not args.no_shuffle, args.merge)
+    print('{:<12} {:>10} {:>10} {:>16} {:>16}'.format('Layout', 'Size (MB)', 'Open (ms)', 'Station (ms)',
+                                                      'Slowest (ms)'))
+    _print_benchmark('current', benchmark_reads(data.data_files(), args.samples))
+    _print_benchmark('repacked', benchmark_reads(files, args.samples))
@@ -0,0 +1,52 @@
+import os
+import sys
+
+"""
+Finds the files that the program reads. Only uses the standard library, so that the window can be shown before the
+scientific libraries (numpy, pandas, xarray) have loaded.
+
+Data is read in place from a data directory, rather than bundled into the packaged application, where it would have to
+be unpacked to a temporary folder every time the program starts. The data directory is the first of:
+* the directory named by the HEEAT_DATA environment variable
+* when packaged, the data directory next to the executable (if it exists)
+* the data directory in the current working directory, or in the bundle when packaged
+"""
+
+# Environment variable that can point the program at a data directory anywhere
+DATA_DIRECTORY_VARIABLE = 'HEEAT_DATA'
+
+
+# Returns the absolute path of the data directory
+def data_directory():
+    directory = os.environ.get(DATA_DIRECTORY_VARIABLE)
+    if directory:
+        return os.path.abspath(directory)
+    if getattr(sys, 'frozen', False):
+        directory = os.path.join(os.path.dirname(sys.executable), 'data')
+        if os.path.isdir(directory):
+            return directory
+    return resource_path('data')
+
+
+# Returns the absolute path of a file in the data directory
+def data_path(name):
+    return os.path.join(data_directory(), name)
+
+
+# For populating the station dropdown in the GUI
+def get_all_stations():
+    with open(data_path('locations.txt'), 'r') as file:
+        stations = file.read().split('\n')
+    return stations
+
+
+# Helps the program find where files are when packaged into an application by PyInstaller
+# Works for dev environment as well
+# Returns the absolute path
+def resource_path(relative_path):
+    try:
+        # PyInstaller creates a temp folder and stores path in _MEIPASS
+        base_path = sys._MEIPASS
+    except Exception:
+        base_path = os.path.abspath(".")
+    return os.path.join(base_path, relative_path)
@@ -0,0 +1,158 @@
+import collections
+import hashlib
+import json
+import sqlite3
+import threading
+import numpy
+from source import data, events
+
+"""
+Remembers the results of previous queries, so that repeating a query returns immediately.
+
+Results are keyed by a hash of the normalized query parameters together with the fingerprint of the data files, so any
+change to the netCDF files in data/ invalidates every entry. Recent results are kept in memory. Optionally, results can
+also be kept in an SQLite database on disk, to be shared between runs and between users of the same file. Entries for
+other data files are kept, so a file can also be shared between datasets; only entries for the data in use are read. On
+disk, each result is stored as its int32 start and end indices, and the time axis they index is stored once per
+fingerprint.
+"""
+
+# Default number of query results kept in memory
+DEFAULT_MAX_ENTRIES = 128
+
+# Increase when the layout of the tables on disk, or the way keys are made, changes, so that caches written by older
+# versions are emptied
+SCHEMA_VERSION = 2
+
+
+# Reduces query parameters to only what affects the results, in a fixed form, so that equivalent queries share a key.
+# Optional settings that are missing take their defaults. Thresholds of variables with no condition, and percentile
+# options of thresholds that are not percentiles, are ignored.
+def normalize_parameters(parameters):
+    normalized = {
+        'station': int(parameters['station']),
+        'consecutive_days': int(parameters['consecutive_days']),
+        'months': [bool(month) for month in parameters['months']]
+    }
+    for variable in ['temperature', 'precipitation', 'wind']:
+        settings = parameters[variable]
+        if settings['condition'] == 'Any':
+            normalized[variable] = {'condition': 'Any'}
+            continue
+        as_percentile = bool(settings.get('as_percentile', False))
+        normalized[variable] = {
+            'condition': settings['condition'],
+            'value': float(settings['value']),
+            'as_percentile': as_percentile
+        }
+        if as_percentile:
+            normalized[variable]['percentile_by_month'] = bool(settings.get('percentile_by_month', False))
+    return normalized
+
+
+# Returns the cache key for a query against data with the given fingerprint
+def cache_key(parameters, fingerprint):
+    text = json.dumps([normalize_parameters(parameters), fingerprint], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, path=None):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.connection = None
+        self.lock = threading.Lock()
+        if path is not None:
+            self.open_disk(path)
+
+    # Also keeps results in an SQLite database at path, creating it if needed. The cache only ever touches its own
+    # tables, and empties them if they were written with a different SCHEMA_VERSION.
+    def open_disk(self, path):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            if self.connection.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+                self.connection.execute('DROP TABLE IF EXISTS result_cache_events')
+                self.connection.execute('DROP TABLE IF EXISTS result_cache_time_axes')
+                self.connection.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+            self.connection.execute('CREATE TABLE IF NOT EXISTS result_cache_events '
+                                    '(key TEXT PRIMARY KEY, fingerprint TEXT, starts BLOB, ends BLOB)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS result_cache_time_axes '
+                                    '(fingerprint TEXT PRIMARY KEY, time BLOB)')
+            self.connection.commit()
+
+    def close_disk(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    # Returns the events.EventList for a query that has been run before, or None
+    def get(self, parameters):
+        fingerprint = data.data_fingerprint()
+        key = cache_key(parameters, fingerprint)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            if self.connection is not None:
+                row = self.connection.execute('SELECT events.starts, events.ends, time_axes.time '
+                                              'FROM result_cache_events AS events '
+                                              'JOIN result_cache_time_axes AS time_axes '
+                                              'ON events.fingerprint = time_axes.fingerprint '
+                                              'WHERE events.key = ?', (key,)).fetchone()
+                if row is not None:
+                    result = events.EventList(numpy.frombuffer(row[2], dtype='datetime64[ns]'),
+                                              numpy.frombuffer(row[0], dtype=numpy.int32),
+                                              numpy.frombuffer(row[1], dtype=numpy.int32))
+                    self._remember(key, result)
+                    self.hits += 1
+                    return result
+            self.misses += 1
+            return None
+
+    # Stores the results of a query, as an events.EventList
+    def put(self, parameters, result):
+        fingerprint = data.data_fingerprint()
+        key = cache_key(parameters, fingerprint)
+        with self.lock:
+            self._remember(key, result)
+            if self.connection is not None:
+                self.connection.execute('INSERT OR IGNORE INTO result_cache_time_axes VALUES (?, ?)',
+                                        (fingerprint, numpy.asarray(result.time, dtype='datetime64[ns]').tobytes()))
+                self.connection.execute('INSERT OR REPLACE INTO result_cache_events VALUES (?, ?, ?, ?)',
+                                        (key, fingerprint, result.starts.tobytes(), result.ends.tobytes()))
+                self.connection.commit()
+
+    # Empties the cache in memory, and on disk if open
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            if self.connection is not None:
+                self.connection.execute('DELETE FROM result_cache_events')
+                self.connection.execute('DELETE FROM result_cache_time_axes')
+                self.connection.commit()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'disk': self.connection is not None
+            }
+
+    def _remember(self, key, result):
+        self.entries[key] = result
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+# The cache shared by every query in this process. Memory only, unless open_disk is called.
+cache = ResultCache()
@@ -0,0 +1,231 @@
+import concurrent.futures
+import http.server
+import json
+import logging
+import math
+import threading
+import time
+import urllib.parse
+from source import climatology, query, resources, result_cache, station_cache, station_store
+
+"""
+A long-running query server for notebooks, dashboards and scripts, so they can run queries without starting a new
+process (and paying for imports and opening the data files) every time. It listens on localhost only by default, needs
+no external services, and keeps its data warm: stations stay in the station cache, and results in the result cache,
+between requests.
+
+Endpoints, all returning JSON:
+
+    GET  /health           status of the server and its caches
+    GET  /stations         station names, in index order
+    POST /query            searches one station. The body is the parameters in the structure described in
+                           query.ThreadedQuery.run. Returns the events, and statistics about them (see
+                           events.event_statistics).
+    POST /batch            searches every station with the same parameters (the station is ignored). Add
+                           ?counts_only=1 to return only the number of events at each station.
+
+Example:
+
+    curl -X POST http://127.0.0.1:8765/query -d '{"station": 0, "consecutive_days": 3, "months": [true, true, true,
+        true, true, true, true, true, true, true, true, true], "temperature": {"condition": "Higher Than",
+        "value": 35}, "precipitation": {"condition": "Any"}, "wind": {"condition": "Any"}}'
+
+Requests are answered by a fixed number of worker threads. While every worker is busy, new connections wait in the
+listen backlog rather than starting more threads.
+"""
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+# Default number of requests answered at once
+DEFAULT_WORKERS = 4
+
+# Largest request body accepted, in bytes
+MAX_BODY_SIZE = 1024 * 1024
+
+CONDITIONS = ['Any', 'Higher Than', 'Lower Than']
+
+logger = logging.getLogger(__name__)
+
+
+# Raised for requests that cannot be answered, with the HTTP status to reply with
+class RequestError(Exception):
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+# Checks that parameters received over HTTP have the structure described in query.ThreadedQuery.run, filling in
+# optional settings.
+# Returns the parameters, or raises RequestError
+def validate_parameters(parameters):
+    if not isinstance(parameters, dict):
+        raise RequestError(400, 'Parameters must be a JSON object')
+    for key in ['station', 'consecutive_days', 'months', 'temperature', 'precipitation', 'wind']:
+        if key not in parameters:
+            raise RequestError(400, 'Missing parameter: ' + key)
+    if not isinstance(parameters['station'], int) or isinstance(parameters['station'], bool):
+        raise RequestError(400, 'station must be an integer')
+    days = parameters['consecutive_days']
+    if not isinstance(days, int) or isinstance(days, bool) or not 1 <= days <= 365:
+        raise RequestError(400, 'consecutive_days must be an integer between 1 and 365')
+    months = parameters['months']
+    if not isinstance(months, list) or len(months) != 12 or not all(isinstance(month, bool) for month in months):
+        raise RequestError(400, 'months must be a list of 12 booleans')
+    if not any(months):
+        raise RequestError(400, 'Select at least one month')
+    for variable in ['temperature', 'precipitation', 'wind']:
+        settings = parameters[variable]
+        if not isinstance(settings, dict) or settings.get('condition') not in CONDITIONS:
+            raise RequestError(400, '{}.condition must be one of: {}'.format(variable, ', '.join(CONDITIONS)))
+        settings.setdefault('as_percentile', False)
+        settings.setdefault('percentile_by_month', False)
+        settings.setdefault('value', None)
+        for key in ['as_percentile', 'percentile_by_month']:
+            if not isinstance(settings[key], bool):
+                raise RequestError(400, '{}.{} must be a boolean'.format(variable, key))
+        if settings['condition'] == 'Any':
+            continue
+        value = settings['value']
+        if not isinstance(value, (int, float)) or isinstance(value, bool) or not math.isfinite(value):
+            raise RequestError(400, '{}.value must be a number'.format(variable))
+        if settings['as_percentile'] and not 0 <= value <= 100:
+            raise RequestError(400, '{}.value must be between 0 and 100 for a percentile'.format(variable))
+    if all(parameters[variable]['condition'] == 'Any' for variable in ['temperature', 'precipitation', 'wind']):
+        raise RequestError(400, 'No conditions have been selected')
+    return parameters
+
+
+# Turns an events.EventList into a list of {} with start_date and end_date as YYYY-MM-DD, formatting every date at once
+def format_events(results):
+    start_dates, end_dates = results.iso_dates()
+    return [{'start_date': start, 'end_date': end} for start, end in zip(start_dates.tolist(), end_dates.tolist())]
+
+
+class QueryRequestHandler(http.server.BaseHTTPRequestHandler):
+    server_version = 'HEEATQueryServer/1.0'
+
+    def do_GET(self):
+        self._respond(self._get)
+
+    def do_POST(self):
+        self._respond(self._post)
+
+    def _get(self, path, arguments):
+        if path == '/health':
+            return {
+                'status': 'ok',
+                'uptime': time.perf_counter() - self.server.start_time,
+                'workers': self.server.workers,
+                'result_cache': result_cache.cache.stats(),
+                'station_cache': station_cache.cache.stats()
+            }
+        if path == '/stations':
+            return resources.get_all_stations()
+        raise RequestError(404, 'Not found: ' + path)
+
+    def _post(self, path, arguments):
+        if path not in ('/query', '/batch'):
+            raise RequestError(404, 'Not found: ' + path)
+        parameters = validate_parameters(self._read_json())
+        if path == '/query':
+            try:
+                results = query.run_query(parameters)
+            except KeyError as e:
+                raise RequestError(404, str(e.args[0]) if e.args else 'Station not found')
+            return {'station': parameters['station'], 'count': len(results), 'statistics': results.statistics(),
+                    'events': format_events(results)}
+        counts_only = arguments.get('counts_only', ['0'])[0].lower() in ('1', 'true', 'yes')
+        results = query.batch_query(parameters, counts_only)
+        if counts_only:
+            return [{'station': station, 'count': count} for station, count in results.items()]
+        return [{'station': station, 'count': len(events), 'statistics': events.statistics(),
+                 'events': format_events(events)} for station, events in results.items()]
+
+    def _read_json(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            raise RequestError(400, 'Invalid Content-Length')
+        if length > MAX_BODY_SIZE:
+            raise RequestError(413, 'Request body is too large')
+        try:
+            return json.loads(self.rfile.read(length).decode('utf-8'))
+        except ValueError:
+            raise RequestError(400, 'Request body must be JSON')
+
+    # Answers a request with the JSON returned by handler, or with an error
+    def _respond(self, handler):
+        url = urllib.parse.urlsplit(self.path)
+        try:
+            status, body = 200, handler(url.path, urllib.parse.parse_qs(url.query))
+        except RequestError as e:
+            status, body = e.status, {'error': str(e)}
+        except MemoryError:
+            status, body = 503, {'error': 'Insufficient memory to complete the request'}
+        except Exception:
+            logger.exception('Error answering ' + self.path)
+            status, body = 500, {'error': 'There was a problem with the query'}
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logger.info('%s %s', self.address_string(), format % args)
+
+
+# An HTTP server that answers requests on a fixed pool of worker threads. The listening thread waits for a free worker
+# before accepting the next connection, so a burst of requests queues in the listen backlog instead of starting a thread
+# for each one.
+class QueryServer(http.server.HTTPServer):
+    def __init__(self, address, workers=DEFAULT_WORKERS):
+        http.server.HTTPServer.__init__(self, address, QueryRequestHandler)
+        self.workers = workers
+        self.start_time = time.perf_counter()
+        self.free_workers = threading.Semaphore(workers)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers,
+                                                              thread_name_prefix='query-worker')
+
+    def process_request(self, request, client_address):
+        self.free_workers.acquire()
+        self.executor.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.free_workers.release()
+
+    def server_close(self):
+        http.server.HTTPServer.server_close(self)
+        self.executor.shutdown(wait=True)
+
+
+# Loads what queries need before the first request, so that it is answered as quickly as later ones: checks (and if
+# needed rebuilds) the station store, loads the given stations into the station cache, and, if percentiles is True,
+# loads the climatology table.
+def warm_up(stations=(), percentiles=False):
+    logger.info('{} stations available'.format(station_store.station_count()))
+    for station in stations:
+        station_cache.load_station(station)
+    if percentiles:
+        climatology.load_climatology()
+
+
+# Starts a server and answers requests until interrupted
+def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, workers=DEFAULT_WORKERS, stations=(), percentiles=False):
+    warm_up(stations, percentiles)
+    server = QueryServer((host, port), workers)
+    logger.info('Listening on http://{}:{}/ with {} workers'.format(host, server.server_address[1], workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
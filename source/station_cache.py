@@ -0,0 +1,186 @@
+import collections
+import functools
+import threading
+from source import data, station_store
+
+"""
+Keeps recently used stations in memory, so repeat queries at the same station skip reading the data entirely.
+
+Stations are evicted least recently used first once the total size of the cached data exceeds the memory budget. The
+whole cache is emptied if the data files change.
+
+The station selected in the GUI can be loaded in the background before the query is run (see Prewarmer), so that the
+query finds it already in memory.
+"""
+
+# Default memory budget for cached station data, in bytes
+DEFAULT_BUDGET = 256 * 1024 * 1024
+
+# How often a caller waiting for another thread's load checks whether it has been cancelled, in seconds
+CANCEL_CHECK_INTERVAL = 0.1
+
+
+class StationCache:
+    def __init__(self, budget=DEFAULT_BUDGET):
+        self.budget = budget
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.fingerprint = None
+        self.loading = {}
+        self.lock = threading.Lock()
+
+    # Returns the cached data for a station, loading it with load_station(station) on a miss. The same Dataset is shared
+    # by every caller, so it must not be modified. If another thread is already loading the station, waits for that load
+    # instead of reading the station a second time.
+    # The loader may return None (for example, if the load was cancelled), in which case None is returned. None is also
+    # returned if the optional threading.Event cancelled is set while waiting for another thread's load.
+    def get(self, station, loader=station_store.load_station, cancelled=None):
+        fingerprint = data.data_fingerprint()
+        while True:
+            with self.lock:
+                if fingerprint != self.fingerprint:
+                    self._clear()
+                    self.fingerprint = fingerprint
+                if station in self.entries:
+                    self.entries.move_to_end(station)
+                    self.hits += 1
+                    return self.entries[station]
+                loaded = self.loading.get(station)
+                if loaded is None:
+                    self.misses += 1
+                    loaded = self.loading[station] = threading.Event()
+                    break
+            while not loaded.wait(CANCEL_CHECK_INTERVAL):
+                if cancelled is not None and cancelled.is_set():
+                    return None
+        try:
+            station_data = loader(station)
+            if station_data is not None:
+                self.put(station, station_data)
+        finally:
+            with self.lock:
+                del self.loading[station]
+            loaded.set()
+        return station_data
+
+    # Returns True if the station is cached, without counting a hit or miss
+    def contains(self, station):
+        with self.lock:
+            return station in self.entries
+
+    # Adds a station's data to the cache, evicting the least recently used stations if over budget. Data larger than the
+    # whole budget is not cached.
+    def put(self, station, station_data):
+        size = _dataset_size(station_data)
+        with self.lock:
+            if station in self.entries:
+                self.size -= _dataset_size(self.entries.pop(station))
+            if size > self.budget:
+                return
+            self.entries[station] = station_data
+            self.size += size
+            self._evict()
+
+    # Changes the memory budget, in bytes, evicting stations if the cache is now over budget
+    def set_budget(self, budget):
+        with self.lock:
+            self.budget = budget
+            self._evict()
+
+    def clear(self):
+        with self.lock:
+            self._clear()
+
+    # Returns the hit and miss counters and current usage, for tuning the budget
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'stations': len(self.entries),
+                'size': self.size,
+                'budget': self.budget
+            }
+
+    def _clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def _evict(self):
+        while self.size > self.budget and len(self.entries) > 0:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= _dataset_size(evicted)
+
+
+def _dataset_size(dataset):
+    return sum(variable.nbytes for variable in dataset.variables.values())
+
+
+# Loads stations into a cache in the background, one at a time, on a thread of its own. Only the most recent request
+# matters: a new request cancels the load in progress, which stops before reading its next variable, and replaces any
+# request still waiting. Switching between stations quickly therefore never builds up a backlog of reads.
+class Prewarmer:
+    def __init__(self, cache):
+        self.cache = cache
+        self.station = None
+        self.cancelled = None
+        self.thread = None
+        self.condition = threading.Condition()
+
+    # Starts loading a station in the background, cancelling any earlier request
+    def request(self, station):
+        with self.condition:
+            self._cancel()
+            self.station = station
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    # Cancels the load in progress and any request still waiting
+    def cancel(self):
+        with self.condition:
+            self._cancel()
+
+    def _cancel(self):
+        self.station = None
+        if self.cancelled is not None:
+            self.cancelled.set()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.station is None:
+                    self.condition.wait()
+                station = self.station
+                self.station = None
+                cancelled = self.cancelled = threading.Event()
+            try:
+                self.cache.get(station, functools.partial(station_store.load_station, cancelled=cancelled), cancelled)
+            except Exception:
+                # Prewarming is only an optimisation. Any problem with the data is reported when the query is run.
+                pass
+
+
+# The cache shared by every query in this process
+cache = StationCache()
+
+# Loads stations into the shared cache in the background
+prewarmer = Prewarmer(cache)
+
+
+# Loads a single station through the shared cache. If the optional threading.Event cancelled is set while the station
+# is being read, or while waiting for another thread to read it, stops early and returns None.
+#   progress: optional function called with the fraction (0-1) of the station's variables read, if it is read here
+def load_station(station, cancelled=None, progress=None):
+    if cancelled is None and progress is None:
+        return cache.get(station)
+    return cache.get(station, functools.partial(station_store.load_station, cancelled=cancelled, progress=progress),
+                     cancelled)
+
+
+# Starts loading a station into the shared cache in the background, cancelling any earlier request
+def prewarm(station):
+    prewarmer.request(station)
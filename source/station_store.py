@@ -0,0 +1,206 @@
+import xarray
+import numpy
+import argparse
+import logging
+import json
+import os
+import shutil
+from source import data, resources
+
+"""
+A station-major copy of the netCDF data, built once and then memory-mapped at query time.
+
+Each variable is stored as a float32 .npy array of shape (region, time), so every station's series is one contiguous
+block on disk. The shared time axis and region coordinate are stored alongside. Reading a station maps only its rows,
+skipping netCDF/HDF5 decompression entirely.
+
+A manifest records the store version and a fingerprint of the source files. If either no longer matches, queries read
+the netCDF files instead, with a warning, until the store is rebuilt by running this module. A rebuild never writes over
+the files of the store in use, which running queries may have memory-mapped.
+"""
+
+# Increase when the layout of the store changes, so that stores built by older versions are rebuilt
+STORE_VERSION = 1
+
+# Number of stations copied from the netCDF files at a time while building the store
+BUILD_CHUNK_SIZE = 64
+
+logger = logging.getLogger(__name__)
+
+# Stores that have been found to be out of date, so the warning is only logged once for each
+_stale_warned = set()
+
+
+# Returns the default location of the store
+def default_store_path():
+    return resources.data_path('station_store')
+
+
+def _manifest_path(path):
+    return os.path.join(path, 'manifest.json')
+
+
+def _array_path(path, name):
+    return os.path.join(path, name + '.npy')
+
+
+# Returns True if a store has been built at the given path, whether or not it is up to date
+def store_exists(path=None):
+    path = default_store_path() if path is None else path
+    return os.path.exists(_manifest_path(path))
+
+
+# Returns True if the store at the given path was built by this version from the current netCDF files
+def store_is_current(path=None):
+    path = default_store_path() if path is None else path
+    try:
+        with open(_manifest_path(path), 'r') as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        return False
+    if manifest.get('version') != STORE_VERSION or manifest.get('fingerprint') != data.data_fingerprint():
+        return False
+    names = data.VARIABLES + ['time', 'region']
+    return all(os.path.exists(_array_path(path, name)) for name in names)
+
+
+# Builds the store from the netCDF files. Stations are copied in chunks so memory use stays bounded regardless of the
+# number of stations. The new store is built in a separate directory, with its manifest written last, and only then
+# swapped in as a whole, so an interrupted build is never mistaken for a valid store, and files that running queries
+# have memory-mapped are never written over. If the old store cannot be moved aside (on Windows, while its files are
+# mapped), an OSError is raised and the old store is left as it was.
+def build_store(path=None, chunk_size=BUILD_CHUNK_SIZE):
+    path = default_store_path() if path is None else path
+    logger.info('Building station store in ' + path)
+    new_path = path + '.new'
+    shutil.rmtree(new_path, ignore_errors=True)
+    os.makedirs(new_path)
+    fingerprint = data.data_fingerprint()
+    with data.open_dataset() as dataset:
+        numpy.save(_array_path(new_path, 'time'), dataset.time.values)
+        numpy.save(_array_path(new_path, 'region'), dataset.region.values)
+        n_stations = dataset.region.size
+        n_times = dataset.time.size
+        for variable in data.VARIABLES:
+            logger.info('Copying ' + variable)
+            array = numpy.lib.format.open_memmap(_array_path(new_path, variable), mode='w+', dtype=numpy.float32,
+                                                 shape=(n_stations, n_times))
+            for start in range(0, n_stations, chunk_size):
+                stop = min(start + chunk_size, n_stations)
+                chunk = dataset[variable].isel(region=slice(start, stop)).transpose('region', 'time')
+                array[start:stop] = chunk.values
+            array.flush()
+            del array
+    with open(_manifest_path(new_path), 'w') as file:
+        json.dump({
+            'version': STORE_VERSION,
+            'fingerprint': fingerprint,
+            'variables': data.VARIABLES,
+            'stations': int(n_stations),
+            'times': int(n_times)
+        }, file)
+    old_path = path + '.old'
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(path):
+        os.replace(path, old_path)
+    os.replace(new_path, path)
+    # Fails quietly where the old files are still mapped, and is tried again by the next build
+    shutil.rmtree(old_path, ignore_errors=True)
+    _stale_warned.discard(path)
+    logger.info('Station store complete')
+
+
+# Deletes the store at the given path, along with any unfinished or replaced store left by build_store
+def remove_store(path=None):
+    path = default_store_path() if path is None else path
+    for directory in [path, path + '.new', path + '.old']:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+# Reads a single station from the store by memory-mapping each variable and copying only that station's row. Takes
+# cancelled and progress as described in data.load_station.
+# Returns a Dataset with a region dimension of length 1, or None if cancelled, the same as data.load_station.
+def read_station(station, path=None, cancelled=None, progress=None):
+    path = default_store_path() if path is None else path
+    region = numpy.load(_array_path(path, 'region'))
+    positions = numpy.flatnonzero(region == station)
+    if positions.size == 0:
+        raise KeyError('Station {} is not in the dataset'.format(station))
+    position = int(positions[0])
+    time = numpy.load(_array_path(path, 'time'))
+    variables = {}
+    for i, variable in enumerate(data.VARIABLES):
+        if cancelled is not None and cancelled.is_set():
+            return None
+        array = numpy.load(_array_path(path, variable), mmap_mode='r')
+        variables[variable] = (('region', 'time'), numpy.array(array[position:position + 1]))
+        del array
+        if progress is not None:
+            progress((i + 1) / len(data.VARIABLES))
+    return xarray.Dataset(variables, coords={'region': region[position:position + 1], 'time': time})
+
+
+# Reads stations from the store in chunks of consecutive positions, the same as data.iter_station_chunks
+def read_station_chunks(chunk_size, start=0, stop=None, path=None):
+    path = default_store_path() if path is None else path
+    region = numpy.load(_array_path(path, 'region'))
+    time = numpy.load(_array_path(path, 'time'))
+    arrays = {variable: numpy.load(_array_path(path, variable), mmap_mode='r') for variable in data.VARIABLES}
+    stop = region.size if stop is None else min(stop, region.size)
+    for chunk_start in range(start, stop, chunk_size):
+        chunk = slice(chunk_start, min(chunk_start + chunk_size, stop))
+        variables = {variable: (('region', 'time'), numpy.array(arrays[variable][chunk]))
+                     for variable in data.VARIABLES}
+        yield xarray.Dataset(variables, coords={'region': region[chunk], 'time': time})
+
+
+# Returns True if the store should be used in place of the netCDF files. A store that no longer matches the netCDF files
+# is not used, and is left to be rebuilt by running this module, rather than rebuilt by whichever query finds it.
+def _use_store(path):
+    if not store_exists(path):
+        return False
+    if store_is_current(path):
+        return True
+    if path not in _stale_warned:
+        _stale_warned.add(path)
+        logger.warning('The station store in {} is out of date, so the netCDF files are read instead. Rebuild it with: '
+                       'python -m source.station_store'.format(path))
+    return False
+
+
+# Loads a single station, preferring the store when one is up to date. Otherwise the netCDF files are read directly.
+# Takes cancelled and progress as described in data.load_station.
+def load_station(station, path=None, cancelled=None, progress=None):
+    path = default_store_path() if path is None else path
+    if _use_store(path):
+        return read_station(station, path, cancelled, progress)
+    return data.load_station(station, cancelled, progress)
+
+
+# Returns the number of stations, preferring the store when one is up to date
+def station_count(path=None):
+    path = default_store_path() if path is None else path
+    if _use_store(path):
+        return numpy.load(_array_path(path, 'region'), mmap_mode='r').size
+    return data.station_count()
+
+
+# Loads stations in chunks, preferring the store when one is up to date, the same as data.iter_station_chunks
+def iter_station_chunks(chunk_size, start=0, stop=None, path=None):
+    path = default_store_path() if path is None else path
+    if _use_store(path):
+        return read_station_chunks(chunk_size, start, stop, path)
+    return data.iter_station_chunks(chunk_size, start, stop)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s",
+                        datefmt="%Y-%m-%d  %H:%M:%S")
+    parser = argparse.ArgumentParser(description='Build the station-major store from the netCDF files in data/')
+    parser.add_argument('--path', default=None, help='Directory to build the store in (default: data/station_store)')
+    parser.add_argument('--force', action='store_true', help='Rebuild even if the store is up to date')
+    args = parser.parse_args()
+    if args.force or not store_is_current(args.path):
+        build_store(args.path)
+    else:
+        logger.info('Station store is up to date')
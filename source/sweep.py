@@ -0,0 +1,212 @@
+import copy
+import itertools
+import numpy
+from source import climatology, events, query
+from source.station_cache import load_station
+
+"""
+Counts events for a whole grid of thresholds and durations at once, reading the station's data only once.
+
+For temperature and wind, the count for every threshold and duration comes from a single pass over the series. Lowering
+a "Higher Than" threshold only ever joins days into longer runs, so every run that exists at any threshold corresponds
+to one node of a Cartesian tree over the series: a span of days whose lowest value sets the highest threshold at which
+the run exists, and whose neighbouring days set the lowest. Finding every node is linear in the number of days, and each
+(threshold, duration) count is then a pair of binary searches over the sorted nodes.
+
+Precipitation is compared as an accumulation, and events are picked greedily from overlapping windows, so counts do not
+nest across thresholds in the same way. When precipitation is part of the query (or events are to be returned, or
+percentiles are by month), the accumulation and the conditions that are not swept are worked out once for each duration,
+and only the comparisons with the swept thresholds are repeated for each combination of thresholds.
+"""
+
+# The data variable compared against the threshold for each variable and condition
+SWEEP_VARIABLES = {
+    ('temperature', 'Higher Than'): 'maximum_temperature',
+    ('temperature', 'Lower Than'): 'minimum_temperature',
+    ('wind', 'Higher Than'): 'windspeed',
+    ('wind', 'Lower Than'): 'windspeed'
+}
+
+
+# Finds every run that can exist at some threshold in a series, as nodes of a Cartesian tree. A day is part of a run if
+# its score is higher than the threshold. Days that can never be part of a run have a score of -inf.
+# Returns (lengths, lowest, highest): each run's length, and the range of thresholds lowest <= T < highest for which it
+# is a complete run
+def run_intervals(score):
+    n = score.size
+    values = score.tolist()
+    previous_lower = numpy.full(n, -1, dtype=numpy.int64)
+    next_lower_or_equal = numpy.full(n, n, dtype=numpy.int64)
+    stack = []
+    for i, value in enumerate(values):
+        while stack and values[stack[-1]] >= value:
+            next_lower_or_equal[stack.pop()] = i
+        if stack:
+            previous_lower[i] = stack[-1]
+        stack.append(i)
+    padded = numpy.concatenate((score, [-numpy.inf]))
+    lowest = numpy.maximum(padded[previous_lower], padded[next_lower_or_equal])
+    valid = lowest < score
+    return (next_lower_or_equal - previous_lower - 1)[valid], lowest[valid], score[valid]
+
+
+# Counts runs of at least each number of consecutive days in which the score is higher than each threshold.
+# Returns a (thresholds, consecutive_days) array of counts
+def count_runs(score, thresholds, consecutive_days):
+    lengths, lowest, highest = run_intervals(score)
+    thresholds = numpy.asarray(thresholds, dtype=numpy.float64)
+    counts = numpy.zeros((thresholds.size, len(consecutive_days)), dtype=numpy.int64)
+    for j, days in enumerate(consecutive_days):
+        long_enough = lengths >= days
+        counts[:, j] = (numpy.searchsorted(numpy.sort(lowest[long_enough]), thresholds, side='right') -
+                        numpy.searchsorted(numpy.sort(highest[long_enough]), thresholds, side='right'))
+    return counts
+
+
+# Turns values into scores that are higher than the (equally transformed) threshold exactly when the condition is met.
+# Values are widened to float64, which is exact, so thresholds must already be rounded to the values' own type where the
+# query would compare in that type. Days that are missing, or excluded by mask, can never meet the condition.
+def _score(values, condition, mask):
+    score = values.astype(numpy.float64) if condition == 'Higher Than' else -values.astype(numpy.float64)
+    return numpy.where(mask & ~numpy.isnan(score), score, -numpy.inf)
+
+
+# Works out the threshold for each of the values swept for a variable, in the form returned by query.resolve_thresholds.
+# Percentiles of precipitation accumulated over several days are all calculated from a single accumulation.
+# Returns a list with a threshold for each value
+def sweep_thresholds(data, parameters, variable, values, consecutive_days):
+    settings = parameters[variable]
+    if not settings.get('as_percentile', False):
+        return [float(value) for value in values]
+    by_month = settings.get('percentile_by_month', False)
+    if variable == 'precipitation' and consecutive_days > 1:
+        accumulation = events.rolling_sum(data['precipitation'].values, consecutive_days)
+        percentiles = [float(value) for value in values]
+        if by_month:
+            months = data['time.month'].values
+            table = climatology.monthly_quantiles(accumulation, months, percentiles)
+            return [table[:, months, i] for i in range(len(percentiles))]
+        table = climatology.quantiles(accumulation, percentiles)
+        return [table[:, i, numpy.newaxis] for i in range(len(percentiles))]
+    # Other percentiles are looked up in the climatology table
+    single_parameters = {name: {'condition': 'Any'} for name in ['temperature', 'precipitation', 'wind']}
+    single_parameters[variable] = dict(settings)
+    single_parameters['consecutive_days'] = consecutive_days
+    thresholds = []
+    for value in values:
+        single_parameters[variable]['value'] = float(value)
+        thresholds.append(query.resolve_thresholds(data, single_parameters)[variable])
+    return thresholds
+
+
+# Counts events for every combination of thresholds and durations at a single station.
+#   parameters: query parameters in the structure described in query.ThreadedQuery.run. Variables not being swept keep
+#               their condition and value. consecutive_days is ignored.
+#   thresholds: {} of variable ('temperature', 'precipitation' or 'wind') to a list of values to sweep. The variable's
+#               condition, and whether values are percentiles, are taken from parameters. The condition must not be
+#               'Any'.
+#   consecutive_days: list of durations to sweep
+#   return_events: if True, also return the events for every combination
+#
+# Returns results in the following structure:
+# results: {}
+#   thresholds: {} variable: numpy array of values, in the order given
+#   consecutive_days: numpy array of durations
+#   counts: numpy array of counts, with one axis per swept variable followed by one for consecutive_days
+#   events: {} (only if return_events) (threshold values..., consecutive_days) <- tuple: events.EventList
+def threshold_sweep(parameters, thresholds, consecutive_days, return_events=False):
+    variables = list(thresholds)
+    for variable in variables:
+        if parameters[variable]['condition'] == 'Any':
+            raise ValueError('A condition must be set for {} to sweep its threshold'.format(variable))
+    values = [numpy.asarray(thresholds[variable], dtype=numpy.float64) for variable in variables]
+    consecutive_days = numpy.asarray(consecutive_days, dtype=numpy.int64)
+    counts = numpy.zeros([value.size for value in values] + [consecutive_days.size], dtype=numpy.int64)
+    results = {
+        'thresholds': dict(zip(variables, values)),
+        'consecutive_days': consecutive_days,
+        'counts': counts
+    }
+
+    data = load_station(parameters['station'])
+    time = data.time.values
+    uses_precipitation = parameters['precipitation']['condition'] != 'Any'
+    by_month = any(parameters[variable].get('as_percentile', False) and
+                   parameters[variable].get('percentile_by_month', False) for variable in variables)
+    # The conditions that are not being swept
+    fixed_parameters = copy.deepcopy(parameters)
+    for variable in variables:
+        fixed_parameters[variable]['condition'] = 'Any'
+
+    if return_events or uses_precipitation or by_month:
+        if return_events:
+            results['events'] = {}
+        series = {variable: data[SWEEP_VARIABLES[(variable, parameters[variable]['condition'])]].values
+                  for variable in variables if variable != 'precipitation'}
+        for j, days in enumerate(consecutive_days):
+            days = int(days)
+            fixed_parameters['consecutive_days'] = days
+            fixed_condition, fixed_precipitation, month_mask = query.build_conditions(data, fixed_parameters)
+            if 'precipitation' in variables:
+                series['precipitation'] = events.rolling_sum(data['precipitation'].values, days, month_mask)
+            levels = [sweep_thresholds(data, parameters, variable, value, days)
+                      for variable, value in zip(variables, values)]
+            for combination in itertools.product(*[range(value.size) for value in values]):
+                conditions = [] if fixed_condition is None else [fixed_condition]
+                precipitation = fixed_precipitation
+                for variable, level, i in zip(variables, levels, combination):
+                    if parameters[variable]['condition'] == 'Higher Than':
+                        met = series[variable] > level[i]
+                    else:
+                        met = series[variable] < level[i]
+                    if variable == 'precipitation':
+                        precipitation = met
+                    else:
+                        conditions.append(met)
+                condition = None
+                if len(conditions) > 0:
+                    condition = numpy.logical_and.reduce(conditions)
+                    if month_mask is not None:
+                        condition = condition & ~month_mask
+                starts, ends = events.find_events(None if condition is None else condition[0],
+                                                  None if precipitation is None else precipitation[0],
+                                                  days, month_mask)
+                counts[combination + (j,)] = starts.size
+                if return_events:
+                    key = tuple(float(value[i]) for value, i in zip(values, combination)) + (days,)
+                    results['events'][key] = events.EventList(time, starts, ends)
+        data.close()
+        return results
+
+    # Days meeting the conditions that are not being swept, within the selected months
+    fixed_condition, _, month_mask = query.build_conditions(data, fixed_parameters)
+    fixed = numpy.ones(time.size, dtype=bool) if fixed_condition is None else fixed_condition[0]
+    if month_mask is not None:
+        fixed = fixed & ~month_mask
+
+    # Sweep the last variable in a single pass for each combination of the other variables' thresholds
+    series = {}
+    for variable in variables:
+        condition = parameters[variable]['condition']
+        series[variable] = _score(data[SWEEP_VARIABLES[(variable, condition)]].values[0], condition, fixed)
+    # Percentiles are turned into the station's values first. Both increase together, so the sweep is unchanged.
+    # Other thresholds are rounded to the data's own type, as queries compare the data with a plain number in that type,
+    # and a day equal to the rounded threshold must be counted the same way here.
+    levels = []
+    for variable, value in zip(variables, values):
+        name = SWEEP_VARIABLES[(variable, parameters[variable]['condition'])]
+        if parameters[variable].get('as_percentile', False):
+            value = numpy.array([climatology.station_percentiles(data, name, percentile)[0] for percentile in value])
+        else:
+            value = value.astype(data[name].dtype).astype(numpy.float64)
+        levels.append(value)
+    inner = variables[-1]
+    inner_thresholds = levels[-1] if parameters[inner]['condition'] == 'Higher Than' else -levels[-1]
+    for combination in itertools.product(*[range(value.size) for value in values[:-1]]):
+        score = series[inner]
+        for variable, value, i in zip(variables[:-1], levels[:-1], combination):
+            threshold = value[i] if parameters[variable]['condition'] == 'Higher Than' else -value[i]
+            score = numpy.where(series[variable] > threshold, score, -numpy.inf)
+        counts[combination] = count_runs(score, inner_thresholds, consecutive_days)
+    data.close()
+    return results
@@ -6,10 +6,13 @@ import logging
 """
 Saves an xarray Dataset to a netCDF file, with a progress bar (really common use case in this package).
 Can log to a given logger and logging level. If these are not provided, will log on level WARN
+Variables are compressed with zlib unless an encoding is given for them (e.g. to set chunk sizes or compression level).
+Errors are logged rather than raised, unless raise_errors is True, in which case any partly written file is removed and
+the error is raised again, so callers can tell that the file was not written.
 """
 
 
-def save_to_netcdf(dataset, path, encoding=None, logging_level=logging.WARN):
+def save_to_netcdf(dataset, path, encoding=None, logging_level=logging.WARN, unlimited_dims='time', raise_errors=False):
     logging.basicConfig(level=logging.WARN, format="%(asctime)s %(levelname)s: %(message)s",
                         datefmt="%Y-%m-%d  %H:%M:%S")
     logger = logging.getLogger(__name__)
@@ -22,14 +25,18 @@ def save_to_netcdf(dataset, path, encoding=None, logging_level=logging.WARN):
             encoding = {}
         try:
             for key in dataset.keys():
-                encoding[key] = {'zlib': True}
+                encoding.setdefault(key, {'zlib': True})
         except AttributeError:
             pass
-        delayed_obj = dataset.to_netcdf(path, compute=False, format='NETCDF4', engine='netcdf4', unlimited_dims='time',
-                                        encoding=encoding)
+        delayed_obj = dataset.to_netcdf(path, compute=False, format='NETCDF4', engine='netcdf4',
+                                        unlimited_dims=unlimited_dims, encoding=encoding)
         # Write this to log instead of stdout
         logger_writer = LoggerWriter(logger, logging.INFO)
         with ProgressBar(out=logger_writer, dt=1):
             delayed_obj.compute()
     except Exception as e:
         logging.exception(e)
+        if raise_errors:
+            if os.path.exists(path):
+                os.remove(path)
+            raise